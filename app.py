@@ -1,4 +1,5 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
+import json
 import random
 
 app = Flask(__name__, template_folder="frontend")
@@ -7,15 +8,21 @@ app = Flask(__name__, template_folder="frontend")
 def index():
     return render_template('index.html')
 
+# La rutina es fija: se serializa una sola vez al cargar el módulo
+CURRENT_ROUTINE_JSON = json.dumps({
+    "name": "Rutina de respiración guiada",
+    "duration": 30,
+    "intensity": "Moderada",
+    "nextExercise": "Inhalación profunda"
+})
+
 @app.route('/api/routine/current')
 def routine():
-    routine_data = {
-        "name": "Rutina de respiración guiada",
-        "duration": 30,
-        "intensity": "Moderada",
-        "nextExercise": "Inhalación profunda"
-    }
-    return jsonify(routine_data)
+    return Response(
+        CURRENT_ROUTINE_JSON,
+        mimetype="application/json",
+        headers={"Cache-Control": "public, max-age=60"},
+    )
 
 @app.route('/submit', methods=['POST'])
 def submit():
@@ -0,0 +1,76 @@
+"""
+Trabajos programados de IA por la Batch API de OpenAI (fuera de las peticiones interactivas).
+
+Pensado para cron, desde backend/:
+    # cada noche: análisis y rutinas de los usuarios con lecturas recientes
+    0 2 * * *   python -m app.ai_batches submit --kind analysis
+    30 2 * * *  python -m app.ai_batches submit --kind workout
+    # cada 15 min: guarda los resultados de los batches que hayan terminado
+    */15 * * * * python -m app.ai_batches poll
+"""
+import argparse
+import logging
+from datetime import datetime, timedelta
+from typing import List
+
+from dotenv import load_dotenv
+
+from .openai_client import BATCH_WINDOW_HOURS, SmartBreathingOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Estados tras los que no hay nada más que consultar: "collected" (el nuestro, también
+# para los expirados o cancelados, una vez guardados sus resultados parciales) y
+# "failed" de OpenAI (el fichero de entrada no pasó la validación: no hay resultados)
+FINAL_BATCH_STATUSES = ["collected", "failed"]
+
+
+def users_with_recent_readings(ai: SmartBreathingOpenAI, hours: int) -> List[str]:
+    since = datetime.utcnow() - timedelta(hours=hours)
+    user_ids = ai.db.sensor_readings.distinct("user_id", {"timestamp": {"$gte": since}})
+    return [str(u) for u in user_ids]
+
+
+def submit_nightly(kind: str) -> None:
+    ai = SmartBreathingOpenAI()
+    user_ids = users_with_recent_readings(ai, BATCH_WINDOW_HOURS[kind])
+    batch_id = ai.submit_batch(user_ids, kind)
+    if batch_id:
+        logger.info(f"Submitted {kind} batch {batch_id} for {len(user_ids)} users")
+    else:
+        logger.info(f"No users to include in the {kind} batch")
+
+
+def poll_pending() -> None:
+    ai = SmartBreathingOpenAI()
+    pending = ai.db.ai_batches.find(
+        {"status": {"$nin": FINAL_BATCH_STATUSES}}, projection={"batch_id": 1}
+    )
+    for record in pending:
+        try:
+            status = ai.collect_batch(record["batch_id"])
+            logger.info(f"Batch {record['batch_id']}: {status}")
+        except Exception as e:
+            # Un batch con problemas no impide recoger los demás
+            logger.error(f"Error collecting batch {record['batch_id']}: {e}")
+
+
+def main() -> None:
+    # Lanzado desde cron: MONGODB_URI y OPENAI_API_KEY salen del .env, como en main.py
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Batches de IA de SmartBreathing")
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="envía el batch nocturno")
+    submit.add_argument("--kind", choices=sorted(BATCH_WINDOW_HOURS), required=True)
+    commands.add_parser("poll", help="guarda los resultados de los batches terminados")
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        submit_nightly(args.kind)
+    else:
+        poll_pending()
+
+
+if __name__ == "__main__":
+    main()
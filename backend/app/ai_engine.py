@@ -1,28 +1,66 @@
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Any
-import statistics
 import random
 import logging
+import threading
+import time
 
 from .models import (
     SensorReading, UserProfile, AIRecommendation, WorkoutRoutine,
     RoutineResponse, ExerciseInRoutine
 )
 from .db import get_database
+from .utils_regex import block_regex_safe, sport_keyword_conditions
 
 logger = logging.getLogger(__name__)
 
-def block_regex_safe(block: str) -> str:
-    """Helper for safe regex construction from block type"""
-    if not block: return "Principal"
-    if "Calentamiento" in block: return "Calentamiento"
-    if "Principal" in block or "Núcleo" in block: return "Principal|Núcleo"
-    if "Vuelta" in block: return "Vuelta"
-    return "Principal"
+# Caché de consultas a Ejercicios: el catálogo se carga desde Excel y casi no cambia,
+# y la cascada de búsqueda repite las mismas consultas entre rutinas (y en el reintento
+# con ["mixto"] del endpoint)
+EXERCISE_CACHE_TTL = 600
+EXERCISE_CACHE_SIZE = 256
 
 class SmartBreathingAI:
     def __init__(self):
         self.db = get_database()
+        self._exercise_query_cache: Dict[tuple, tuple] = {}
+        # El motor se usa desde el threadpool: varias peticiones a la vez sobre la caché
+        self._exercise_query_lock = threading.Lock()
+
+    def ensure_indexes(self) -> None:
+        """
+        Crea los índices B-tree de Ejercicios en tipo_bloque y deporte.
+
+        No aceleran la búsqueda de rutinas: esos campos se filtran con regex sin ancla
+        y sin distinguir mayúsculas, así que MongoDB recorre el índice entero. Solo
+        evitan leer los documentos que no casan. Para que fueran selectivos haría
+        falta guardar campos normalizados (*_norm) al cargar el catálogo y consultar
+        por igualdad.
+        """
+        try:
+            self.db.Ejercicios.create_index([("tipo_bloque", 1)])
+            self.db.Ejercicios.create_index([("deporte", 1)])
+        except Exception as e:
+            logger.error(f"Error creating Ejercicios indexes: {e}")
+
+    def _find_exercises(self, query: Dict[str, Any], limit: int) -> List[Dict]:
+        """find() sobre Ejercicios con caché por consulta durante EXERCISE_CACHE_TTL segundos."""
+        key = (repr(query), limit)
+        with self._exercise_query_lock:
+            cached = self._exercise_query_cache.get(key)
+        if cached and time.monotonic() - cached[0] < EXERCISE_CACHE_TTL:
+            return cached[1]
+
+        # batch_size == limit: el primer batch trae todo, sin getMore
+        # (la consulta va fuera del lock para no serializar las peticiones)
+        found = list(self.db.Ejercicios.find(query).limit(limit).batch_size(limit))
+        with self._exercise_query_lock:
+            self._exercise_query_cache.pop(key, None)
+            if len(self._exercise_query_cache) >= EXERCISE_CACHE_SIZE:
+                # Se descarta la consulta más antigua (orden de inserción)
+                self._exercise_query_cache.pop(next(iter(self._exercise_query_cache)), None)
+            self._exercise_query_cache[key] = (time.monotonic(), found)
+        return found
 
     # -------------------------------------------------------------------------
     # RUTINA A PARTIR DE LA DB
@@ -185,12 +223,7 @@ class SmartBreathingAI:
             if s_name:
                 conditions.append({"deporte": {"$regex": s_name, "$options": "i"}})
             if s_keywords:
-                conditions.extend([
-                    {"modalidad": {"$regex": s_keywords, "$options": "i"}},
-                    {"superficie": {"$regex": s_keywords, "$options": "i"}},
-                    {"tags_ia": {"$regex": s_keywords, "$options": "i"}},
-                    {"ejercicio": {"$regex": s_keywords, "$options": "i"}},
-                ])
+                conditions.extend(sport_keyword_conditions(s_keywords))
             if not conditions: return {}
             return {"$or": conditions}
 
@@ -226,98 +259,90 @@ class SmartBreathingAI:
         c_intensity = {"intensidad_relativa": {"$regex": target_intensity, "$options": "i"}}
 
         # ------------------ 5. ESTRATEGIA DE BÚSQUEDA POR BLOQUE --------------
-        def fetch_block_exercises(block_regex: str, limit: int = 10, is_main: bool = False) -> List[Dict]:
+        # Las "Estrategias" de búsqueda no dependen del bloque: se construyen una
+        # sola vez y se reutilizan en todas las llamadas a fetch_block_exercises.
+        # Cada estrategia es un filtro base sobre el cual aplicamos relaxations (Goal, Int, Level)
+        strategies = []
+
+        # A) Estrategias basadas en Deporte(s) Prioritario(s)
+        for s_name, s_kw in sport_priorities:
+            s_query = get_single_sport_query(s_name, s_kw)
+            strategies.append((f"Sport: {s_name}", s_query, False)) # False = no es fallback "sin material" forzado
+
+        # B) Estrategia de Fallback: Sin Equipamiento (Safety Net)
+        # Especialmente útil en Instalaciones/CasaConMaterial cuando falta el deporte principal
+        if mode_facilities or mode_home_with_equipment:
+             strategies.append(("Fallback: No Equip", filter_no_material, True))
+
+        # Si estamos en modo "no equipment", la base_query ya fuerza "sin material", 
+        # así que las estrategias de deporte de arriba ya están filtradas.
+        # Pero si no hubiera matches por deporte, podríamos querer buscar "cualquier cosa sin material".
+        # Sin embargo, si el deporte del usuario es X y no hay ejercicios de X sin material, 
+        # ¿queremos darle ejercicios Y sin material? Sí, como último recurso.
+        if mode_no_equipment:
+             # Añadimos una estrategia genérica que NO filtra por deporte, solo base_query (que ya es "sin material")
+             strategies.append(("Fallback: Generic No Equip", {}, True))
+
+        def fetch_block_exercises(
+            block_regex: str,
+            strategies: List[tuple],
+            base_query: Dict[str, Any],
+            goal_filter: Dict[str, Any],
+            limit: int = 10,
+        ) -> List[Dict]:
             """
             Devuelve ejercicios siguiendo la cascada de prioridades:
             1. Deporte Prioritario (si aplica)
             2. Deporte Usuario (si diferente)
             3. Fallback General (relleno seguro)
             """
-            goal_filter = get_goal_query_part(routine_type) if is_main and routine_type != "mixto" else {}
-
-            # Definimos "Estrategias" de búsqueda
-            # Cada estrategia es un filtro base sobre el cual aplicamos relaxations (Goal, Int, Level)
-            strategies = []
-
-            # A) Estrategias basadas en Deporte(s) Prioritario(s)
-            for s_name, s_kw in sport_priorities:
-                s_query = get_single_sport_query(s_name, s_kw)
-                strategies.append((f"Sport: {s_name}", s_query, False)) # False = no es fallback "sin material" forzado
-
-            # B) Estrategia de Fallback: Sin Equipamiento (Safety Net)
-            # Especialmente útil en Instalaciones/CasaConMaterial cuando falta el deporte principal
-            if mode_facilities or mode_home_with_equipment:
-                 strategies.append(("Fallback: No Equip", filter_no_material, True))
-
-            # Si estamos en modo "no equipment", la base_query ya fuerza "sin material", 
-            # así que las estrategias de deporte de arriba ya están filtradas.
-            # Pero si no hubiera matches por deporte, podríamos querer buscar "cualquier cosa sin material".
-            # Sin embargo, si el deporte del usuario es X y no hay ejercicios de X sin material, 
-            # ¿queremos darle ejercicios Y sin material? Sí, como último recurso.
-            if mode_no_equipment:
-                 # Añadimos una estrategia genérica que NO filtra por deporte, solo base_query (que ya es "sin material")
-                 strategies.append(("Fallback: Generic No Equip", {}, True))
-
-
             results: List[Dict] = []
             seen_ids = set()
 
             for strat_name, strat_filter, is_fallback in strategies:
                 if len(results) >= limit: break
                 
-                # Construimos los pasos de relajación para esta estrategia
+                # Pasos de relajación para esta estrategia, generados bajo demanda:
+                # si "Strict" ya llena el cupo, los siguientes nunca se construyen
                 def build_steps_for_strat():
-                    steps_local = []
-                    
                     # Base de esta iteración: base_query global + filtro de la estrategia
-                    q_base_iter = base_query.copy()
-                    if "$and" not in q_base_iter: q_base_iter["$and"] = []
-                    
-                    q_base_iter["$and"].append({"tipo_bloque": {"$regex": block_regex, "$options": "i"}})
+                    # (lista nueva: no se debe mutar el $and compartido de base_query)
+                    base_conditions = list(base_query.get("$and", []))
+                    base_conditions.append({"tipo_bloque": {"$regex": block_regex, "$options": "i"}})
                     if strat_filter:
-                        q_base_iter["$and"].append(strat_filter)
+                        base_conditions.append(strat_filter)
 
                     # Pasos de relajación estándar
                     # 1. Todo: Level + Int + Goal
-                    q1 = {"$and": list(q_base_iter["$and"])}
-                    q1["$and"].append(c_level)
-                    q1["$and"].append(c_intensity)
+                    q1 = {"$and": base_conditions + [c_level, c_intensity]}
                     if goal_filter: q1["$and"].append(goal_filter)
-                    steps_local.append(("Strict", q1))
+                    yield ("Strict", q1)
 
                     # 2. Relax Goal: Level + Int
-                    q2 = {"$and": list(q_base_iter["$and"])}
-                    q2["$and"].append(c_level)
-                    q2["$and"].append(c_intensity)
-                    steps_local.append(("Relax Goal", q2))
+                    yield ("Relax Goal", {"$and": base_conditions + [c_level, c_intensity]})
 
                     # 3. Relax Int: Level
-                    q3 = {"$and": list(q_base_iter["$and"])}
-                    q3["$and"].append(c_level)
+                    q3 = {"$and": base_conditions + [c_level]}
                     if goal_filter and is_fallback: # En fallback a veces interesa mantener objetivo
                          q3["$and"].append(goal_filter)
-                    steps_local.append(("Relax Int", q3))
+                    yield ("Relax Int", q3)
 
                     # 4. Solo filtro base (Sport/Fallback)
-                    q4 = {"$and": list(q_base_iter["$and"])}
+                    q4 = {"$and": list(base_conditions)}
                     # Si es fallback puro (sin deporte), intentar mantener al menos el objetivo
                     if is_fallback and goal_filter:
                          q4["$and"].append(goal_filter)
-                    steps_local.append(("Base Strat", q4))
-                    
-                    return steps_local
+                    yield ("Base Strat", q4)
 
                 steps = build_steps_for_strat()
 
                 for step_name, query in steps:
-                    if len(results) >= limit: break
-                    
                     # Clean empty $and
                     if not query.get("$and"): query.pop("$and", None)
 
                     try:
                         logger.debug(f"[Fetch {block_regex}] Strat '{strat_name}' - Step '{step_name}'")
-                        found = list(self.db.Ejercicios.find(query).limit(limit * 3))
+                        found = self._find_exercises(query, limit * 3)
                         
                         valid_batch = []
                         for ex in found:
@@ -332,28 +357,35 @@ class SmartBreathingAI:
                     except Exception as e:
                         logger.error(f"Error in query: {e}")
 
+                    # Se comprueba antes de pedir el siguiente paso al generador
+                    if len(results) >= limit: break
+
             return results[:limit]
 
         # ----------------------- 6. OBTENER BLOQUES ---------------------------
-        warmups = fetch_block_exercises("Calentamiento|Movilidad|Técnica", limit=5)
-        cooldowns = fetch_block_exercises("Vuelta a la calma|Recuperación|Estiramientos", limit=5)
+        warmups = fetch_block_exercises(
+            "Calentamiento|Movilidad|Técnica", strategies, base_query, {}, limit=5
+        )
+        cooldowns = fetch_block_exercises(
+            "Vuelta a la calma|Recuperación|Estiramientos", strategies, base_query, {}, limit=5
+        )
 
         # Bloque principal
+        main_regex = "Principal|Núcleo|Trabajo|Complementario"
         main_block: List[Dict] = []
         if routine_type == "mixto":
             # Mezcla de cardio + fuerza
-            backup_type = routine_type
-
-            routine_type = "aerobico"
-            cardio = fetch_block_exercises("Principal|Núcleo|Trabajo|Complementario", limit=8, is_main=True)
-
-            routine_type = "fuerza"
-            strength = fetch_block_exercises("Principal|Núcleo|Trabajo|Complementario", limit=8, is_main=True)
-
-            routine_type = backup_type
+            cardio = fetch_block_exercises(
+                main_regex, strategies, base_query, get_goal_query_part("aerobico"), limit=8
+            )
+            strength = fetch_block_exercises(
+                main_regex, strategies, base_query, get_goal_query_part("fuerza"), limit=8
+            )
             main_block = cardio + strength
         else:
-            main_block = fetch_block_exercises("Principal|Núcleo|Trabajo|Complementario", limit=15, is_main=True)
+            main_block = fetch_block_exercises(
+                main_regex, strategies, base_query, get_goal_query_part(routine_type), limit=15
+            )
 
         # ----------------------- 7. ENSAMBLAR RUTINA --------------------------
         final_selection: List[Dict] = []
@@ -501,12 +533,12 @@ class SmartBreathingAI:
         # Dado que _is_safe es post-query, lo haremos igual.
 
         # Ejecutamos búsqueda
-        candidates = list(self.db.Ejercicios.find(query).limit(20))
+        candidates = list(self.db.Ejercicios.find(query).limit(20).batch_size(20))
         
         # Si no hay del mismo deporte, relajamos la query (mismo bloque, cualquier deporte compatible)
         if not candidates:
             del query["deporte"]
-            candidates = list(self.db.Ejercicios.find(query).limit(20))
+            candidates = list(self.db.Ejercicios.find(query).limit(20).batch_size(20))
 
         # Filtrar candidatos seguros
         safe_candidates = [c for c in candidates if self._is_safe(user_profile, c)]
@@ -580,35 +612,64 @@ class SmartBreathingAI:
         """Analiza los datos fisiológicos directamente de MongoDB (sin IA)"""
         return self._fallback_analysis(user_id, recent_readings)
 
+    def _summarize_recent_readings(self, user_id: str, hours: int = 2, limit: int = 50) -> Optional[Dict]:
+        """
+        Resume en MongoDB las últimas lecturas del usuario: medias calculadas
+        con $group y solo las series numéricas necesarias para las tendencias.
+        """
+        since = datetime.utcnow() - timedelta(hours=hours)
+        pipeline = [
+            {"$match": {"user_id": user_id, "timestamp": {"$gte": since}}},
+            {"$sort": {"timestamp": -1}},
+            {"$limit": limit},
+            {
+                "$group": {
+                    "_id": None,
+                    "avg_spo2": {"$avg": "$spo2"},
+                    "avg_co2": {"$avg": "$co2"},
+                    "avg_heart_rate": {"$avg": "$heart_rate"},
+                    "spo2": {"$push": "$spo2"},
+                    "co2": {"$push": "$co2"},
+                    "heart_rate": {"$push": "$heart_rate"},
+                    "timestamps": {"$push": "$timestamp"},
+                }
+            },
+        ]
+        return next(self.db.sensor_readings.aggregate(pipeline), None)
+
     def _fallback_analysis(self, user_id: str, recent_readings: List[SensorReading] = None) -> Dict:
         """Análisis básico de respaldo solo con base de datos"""
-        if not recent_readings:
-            since = datetime.utcnow() - timedelta(hours=2)
-            readings_data = list(
-                self.db.sensor_readings.find(
-                    {"user_id": user_id, "timestamp": {"$gte": since}},
-                    sort=[("timestamp", -1)],
-                    limit=50,
-                )
-            )
-            recent_readings = [SensorReading(**r) for r in readings_data]
-
-        if not recent_readings:
-            return {
-                "status": "insufficient_data",
-                "message": "No hay datos suficientes para análisis",
-            }
-
-        spo2_values = [r.spo2 for r in recent_readings]
-        co2_values = [r.co2 for r in recent_readings]
-        hr_values = [r.heart_rate for r in recent_readings]
+        if recent_readings:
+            spo2_values = [r.spo2 for r in recent_readings]
+            co2_values = [r.co2 for r in recent_readings]
+            hr_values = [r.heart_rate for r in recent_readings]
+            timestamps = [r.timestamp for r in recent_readings]
+            # sum/len en vez de statistics.mean (que opera con fracciones exactas)
+            n = len(recent_readings)
+            avg_spo2 = sum(spo2_values) / n
+            avg_co2 = sum(co2_values) / n
+            avg_hr = sum(hr_values) / n
+        else:
+            summary = self._summarize_recent_readings(user_id)
+            if not summary:
+                return {
+                    "status": "insufficient_data",
+                    "message": "No hay datos suficientes para análisis",
+                }
+            spo2_values = summary["spo2"]
+            co2_values = summary["co2"]
+            hr_values = summary["heart_rate"]
+            timestamps = summary["timestamps"]
+            avg_spo2 = summary["avg_spo2"]
+            avg_co2 = summary["avg_co2"]
+            avg_hr = summary["avg_heart_rate"]
 
         analysis = {
             "status": "success",
             "analysis_summary": (
-                f"Análisis básico: SpO2 {statistics.mean(spo2_values):.1f}%, "
-                f"CO2 {statistics.mean(co2_values):.0f}ppm, "
-                f"FC {statistics.mean(hr_values):.0f}bpm"
+                f"Análisis básico: SpO2 {avg_spo2:.1f}%, "
+                f"CO2 {avg_co2:.0f}ppm, "
+                f"FC {avg_hr:.0f}bpm"
             ),
             "alerts": [],
             "trends": [
@@ -626,10 +687,10 @@ class SmartBreathingAI:
             ],
             "next_steps": "Continuar monitoreo",
             "confidence_score": 0.6,
-            "avg_spo2": statistics.mean(spo2_values),
-            "avg_co2": statistics.mean(co2_values),
-            "avg_heart_rate": statistics.mean(hr_values),
-            "data_quality": self._assess_data_quality(recent_readings),
+            "avg_spo2": avg_spo2,
+            "avg_co2": avg_co2,
+            "avg_heart_rate": avg_hr,
+            "data_quality": self._assess_data_quality(timestamps),
             "timestamp": datetime.utcnow(),
         }
         return analysis
@@ -739,18 +800,14 @@ class SmartBreathingAI:
         if len(values) < 2:
             return "stable"
 
+        # Mínimos cuadrados con x = 0..n-1 en forma cerrada:
+        # sum((x - x_mean)^2) = n(n^2 - 1)/12, que nunca es 0 para n >= 2
         n = len(values)
-        x = list(range(n))
-        y = values
+        sum_y = sum(values)
+        sum_xy = sum(i * v for i, v in enumerate(values))
 
-        x_mean = statistics.mean(x)
-        y_mean = statistics.mean(y)
-
-        numerator = sum((x[i] - x_mean) * (y[i] - y_mean) for i in range(n))
-        denominator = sum((x[i] - x_mean) ** 2 for i in range(n))
-
-        if denominator == 0:
-            return "stable"
+        numerator = sum_xy - (n - 1) / 2 * sum_y
+        denominator = n * (n * n - 1) / 12
 
         slope = numerator / denominator
 
@@ -761,17 +818,14 @@ class SmartBreathingAI:
         else:
             return "stable"
 
-    def _assess_data_quality(self, readings: List[SensorReading]) -> str:
-        """Evalúa la calidad de los datos de sensores"""
-        if not readings:
+    def _assess_data_quality(self, timestamps: List[datetime]) -> str:
+        """Evalúa la calidad de los datos de sensores a partir de sus timestamps"""
+        if not timestamps:
             return "poor"
 
-        time_gaps = []
-        for i in range(1, len(readings)):
-            gap = (readings[i].timestamp - readings[i - 1].timestamp).total_seconds()
-            time_gaps.append(gap)
-
-        avg_gap = statistics.mean(time_gaps) if time_gaps else 0
+        # La suma de los huecos consecutivos es telescópica: último - primero
+        n_gaps = len(timestamps) - 1
+        avg_gap = (timestamps[-1] - timestamps[0]).total_seconds() / n_gaps if n_gaps else 0
 
         if avg_gap < 5:
             return "excellent"
@@ -1,34 +1,75 @@
-from fastapi import APIRouter, HTTPException
-from .db import get_database
-from .models import ECGMeasurementIn
+from fastapi import APIRouter, Depends, HTTPException
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from .db import get_db, telemetry_collection
+from .models import ECGMeasurementIn, PyObjectId
+from .responses import MongoJSONResponse
 from bson import ObjectId
+from bson.binary import Binary
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from pydantic import BaseModel
 from datetime import datetime
+from array import array
+from typing import List, Tuple
 import logging
+import sys
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+INT16_MAX = 32767
+
+
+def _pack_signal(signal: List[float]) -> Tuple[Binary, float]:
+    """
+    Empaqueta la señal como int16 little-endian con una escala por documento.
+    Las muestras deben ser finitas (lo garantizan los modelos con allow_inf_nan=False).
+    """
+    peak = max((abs(v) for v in signal), default=0.0)
+    # Un pico subnormal da escala 0: se trata como señal nula
+    scale = peak / INT16_MAX or 1.0
+    packed = array("h", (round(v / scale) for v in signal))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return Binary(packed.tobytes()), scale
+
+
+def _unpack_signal(doc: dict) -> List[float]:
+    """Devuelve la señal como lista de floats (admite documentos antiguos con array)."""
+    senal = doc.get("senal", [])
+    if doc.get("senal_dtype") != "int16":
+        return senal
+    packed = array("h")
+    packed.frombytes(bytes(senal))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    scale = doc.get("senal_scale", 1.0)
+    return [v * scale for v in packed]
+
+def parse_user_oid(user_id: str) -> ObjectId:
+    try:
+        return ObjectId(user_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid user_id format")
+
+
 class CurrentUserRequest(BaseModel):
-    user_id: str
+    user_id: PyObjectId
 
 @router.post("/ecg/current-user")
-async def set_current_ecg_user(request: CurrentUserRequest):
+async def set_current_ecg_user(request: CurrentUserRequest, db: AsyncIOMotorDatabase = Depends(get_db)):
     """
     Sets the current user for ECG measurement.
     Called by frontend when user enters the measurement screen.
     """
-    try:
-        user_oid = ObjectId(request.user_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid user_id format")
+    user_oid = request.user_id
 
-    db = get_database()
-    
-    # Upsert document with _id="current" in ecg_state collection
-    db.ecg_state.update_one(
+    # Upsert document with _id="current" in ecg_state collection.
+    # Devuelve el estado resultante en la misma operación (sin find_one aparte)
+    state = await db.ecg_state.find_one_and_update(
         {"_id": "current"},
         {
             "$set": {
@@ -36,20 +77,20 @@ async def set_current_ecg_user(request: CurrentUserRequest):
                 "updated_at": datetime.utcnow()
             }
         },
-        upsert=True
+        projection={"user_id": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
     
-    return {"status": "ok", "user_id": str(user_oid)}
+    return {"status": "ok", "user_id": str(state["user_id"])}
 
 @router.get("/ecg/current-user")
-async def get_current_ecg_user():
+async def get_current_ecg_user(db: AsyncIOMotorDatabase = Depends(get_db)):
     """
     Gets the current user selected for ECG measurement.
     Called by external MATLAB client.
     """
-    db = get_database()
-    
-    state = db.ecg_state.find_one({"_id": "current"})
+    state = await db.ecg_state.find_one({"_id": "current"}, projection={"user_id": 1})
     
     if not state or "user_id" not in state:
         raise HTTPException(status_code=404, detail="ECG current user not set")
@@ -57,92 +98,118 @@ async def get_current_ecg_user():
     return {"user_id": str(state["user_id"])}
 
 @router.get("/ecg/latest/{user_id}")
-async def get_latest_ecg(user_id: str):
+async def get_latest_ecg(user_id: str, db: AsyncIOMotorDatabase = Depends(get_db)):
     """
     Gets the latest ECG measurement for the given user.
     Returns the signal array, sampling frequency, and timestamp.
     """
-    try:
-        user_oid = ObjectId(user_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid user_id format")
+    user_oid = parse_user_oid(user_id)
 
-    db = get_database()
-    
     # Find the most recent ECG document for this user
-    ecg_doc = db.ecg.find_one(
+    ecg_doc = await db.ecg.find_one(
         {"idUsuario": user_oid},
+        projection={
+            "_id": 0, "idUsuario": 1, "fs": 1, "fecha": 1,
+            "senal": 1, "senal_dtype": 1, "senal_scale": 1, "bpm_mean": 1,
+        },
         sort=[("fecha", -1)]
     )
     
     if not ecg_doc:
         raise HTTPException(status_code=404, detail="No ECG data for this user")
         
+    # La señal puede tener miles de muestras: se serializa directamente con orjson
+    return MongoJSONResponse({
+        "user_id": str(ecg_doc["idUsuario"]),
+        "fs": ecg_doc.get("fs", 200),
+        "signal": _unpack_signal(ecg_doc),
+        "bpm": ecg_doc.get("bpm_mean"),
+        "fecha": ecg_doc.get("fecha").isoformat() if ecg_doc.get("fecha") else None
+    })
+
+@router.get("/ecg/latest/{user_id}/meta")
+async def get_latest_ecg_meta(user_id: str, db: AsyncIOMotorDatabase = Depends(get_db)):
+    """
+    Same as /ecg/latest/{user_id} but without the signal array.
+    Useful to check whether there is a new measurement before downloading it.
+    """
+    user_oid = parse_user_oid(user_id)
+
+    ecg_doc = await db.ecg.find_one(
+        {"idUsuario": user_oid},
+        projection={"senal": 0},
+        sort=[("fecha", -1)]
+    )
+
+    if not ecg_doc:
+        raise HTTPException(status_code=404, detail="No ECG data for this user")
+
     return {
+        "ecg_id": str(ecg_doc["_id"]),
         "user_id": str(ecg_doc["idUsuario"]),
         "fs": ecg_doc.get("fs", 200),
-        "signal": ecg_doc.get("senal", []),
+        "n_muestras": ecg_doc.get("n_muestras"),
+        "bpm": ecg_doc.get("bpm_mean"),
         "fecha": ecg_doc.get("fecha").isoformat() if ecg_doc.get("fecha") else None
     }
 
+def _build_ecg_doc(measurement: ECGMeasurementIn) -> dict:
+    # La señal se guarda como int16 empaquetado (~5x menos que un array de doubles)
+    senal, senal_scale = _pack_signal(measurement.ecg_segment)
+    return {
+        "idUsuario": measurement.user_id,
+        "fecha": measurement.timestamp,
+        "fs": measurement.fs,
+        "senal": senal,
+        "senal_dtype": "int16",
+        "senal_scale": senal_scale,
+        "n_muestras": len(measurement.ecg_segment),
+        # BPM medio también aquí para servir la vista combinada sin leer Mediciones
+        "bpm_mean": measurement.bpm_mean,
+        "origen": "simulink"
+    }
+
 @router.post("/ecg-measurements")
-async def create_ecg_measurement(measurement: ECGMeasurementIn):
+async def create_ecg_measurement(measurement: ECGMeasurementIn, db: AsyncIOMotorDatabase = Depends(get_db)):
     """
     Recibe una medición de ECG y BPM (aprox 5s) desde MATLAB/Simulink.
     Guarda los datos en DOS colecciones:
       1) 'ecg' -> Señal cruda (siempre inserta nuevo)
-      2) 'Mediciones' -> BPM medio (actualiza el más reciente o inserta nuevo)
+      2) 'Mediciones' -> BPM medio (upsert sobre el más reciente)
     """
-    db = get_database()
-    
-    # 1. Preparar datos comunes
-    try:
-        user_oid = ObjectId(measurement.user_id)
-    except Exception:
-        # Asumimos que es válido según instrucciones
-        user_oid = ObjectId(measurement.user_id)
-        
+    # 1. Preparar datos comunes (user_id ya viene validado como ObjectId)
+    user_oid = measurement.user_id
     ts = measurement.timestamp
 
     # 2. Documento para colección 'ecg' (siempre inserta)
-    ecg_doc = {
-        "idUsuario": user_oid,
-        "fecha": ts,
-        "fs": measurement.fs,
-        "senal": measurement.ecg_segment,
-        "origen": "simulink"
-    }
-    res_ecg = db.ecg.insert_one(ecg_doc)
+    ecg_doc = _build_ecg_doc(measurement)
+    res_ecg = await telemetry_collection(db, "ecg").insert_one(ecg_doc)
     ecg_id = str(res_ecg.inserted_id)
 
-    # 3. Lógica para colección 'Mediciones' (Upsert logic manual)
-    # Buscar el documento más reciente para este usuario
-    latest_medicion = db.Mediciones.find_one(
+    # 3. Colección 'Mediciones': upsert en una sola operación sobre el documento
+    # más reciente del usuario (sin lectura previa). El _id se genera aquí para
+    # saber, sin otra consulta, si se ha actualizado o creado el documento.
+    nuevo_id = ObjectId()
+    medicion = await db.Mediciones.find_one_and_update(
         {"idUsuario": user_oid},
-        sort=[("fecha", -1)]
-    )
-
-    if latest_medicion:
-        # Actualizar existente
-        medicion_id = str(latest_medicion["_id"])
-        db.Mediciones.update_one(
-            {"_id": latest_medicion["_id"]},
-            {"$set": {"valores.bpm": measurement.bpm_mean}}
-        )
-        logger.info(f"Updated existing Medicion {medicion_id} with BPM: {measurement.bpm_mean}")
-    else:
-        # Crear nuevo
-        medicion_doc = {
-            "idUsuario": user_oid,
-            "valores": {
-                "bpm": measurement.bpm_mean
+        {
+            "$set": {"valores.bpm": measurement.bpm_mean},
+            "$setOnInsert": {
+                "_id": nuevo_id,
+                "fecha": ts,
+                "quien_realizo": user_oid,
             },
-            "fecha": ts,
-            "quien_realizo": user_oid
-        }
-        res_med = db.Mediciones.insert_one(medicion_doc)
-        medicion_id = str(res_med.inserted_id)
+        },
+        sort=[("fecha", -1)],
+        projection={"_id": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    medicion_id = str(medicion["_id"])
+    if medicion["_id"] == nuevo_id:
         logger.info(f"Created new Medicion {medicion_id} with BPM: {measurement.bpm_mean}")
+    else:
+        logger.info(f"Updated existing Medicion {medicion_id} with BPM: {measurement.bpm_mean}")
 
     logger.info(f"ECG measurement processed. ECG ID: {ecg_id}, Medicion ID: {medicion_id}, User: {measurement.user_id}")
     
@@ -150,3 +217,82 @@ async def create_ecg_measurement(measurement: ECGMeasurementIn):
         "ecg_id": ecg_id,
         "medicion_id": medicion_id
     }
+
+@router.post("/ecg-measurements/batch")
+async def create_ecg_measurements_batch(measurements: List[ECGMeasurementIn], db: AsyncIOMotorDatabase = Depends(get_db)):
+    """
+    Versión por lotes de /ecg-measurements: un insert_many en 'ecg' y un
+    bulk_write de upserts en 'Mediciones' (uno por usuario, con el BPM de su
+    medición más reciente del lote).
+    """
+    if not measurements:
+        raise HTTPException(status_code=400, detail="Empty batch")
+
+    failed = set()
+    try:
+        res_ecg = await telemetry_collection(db, "ecg").insert_many(
+            [_build_ecg_doc(m) for m in measurements], ordered=False
+        )
+        ecg_inserted = len(res_ecg.inserted_ids)
+    except BulkWriteError as e:
+        logger.error(f"Error inserting ECG batch: {e.details.get('writeErrors')}")
+        ecg_inserted = e.details.get("nInserted", 0)
+        # Posiciones del lote cuyo documento de ECG no se ha escrito
+        failed = {err["index"] for err in e.details.get("writeErrors", [])}
+
+    # Solo las mediciones con su ECG guardado actualizan Mediciones
+    latest_by_user = {}
+    for i, m in enumerate(measurements):
+        if i in failed:
+            continue
+        current = latest_by_user.get(m.user_id)
+        if current is None or m.timestamp >= current.timestamp:
+            latest_by_user[m.user_id] = m
+
+    # Mismo destino que /ecg-measurements (find_one_and_update con sort por fecha):
+    # se resuelve antes el _id de la Medicion más reciente de cada usuario, en una consulta
+    latest_ids = {}
+    async for doc in db.Mediciones.aggregate(
+        [
+            {"$match": {"idUsuario": {"$in": list(latest_by_user)}}},
+            {"$sort": {"fecha": -1}},
+            {"$group": {"_id": "$idUsuario", "latest_id": {"$first": "$_id"}}},
+        ]
+    ):
+        latest_ids[doc["_id"]] = doc["latest_id"]
+
+    ops = []
+    for user_oid, m in latest_by_user.items():
+        if user_oid in latest_ids:
+            ops.append(
+                UpdateOne({"_id": latest_ids[user_oid]}, {"$set": {"valores.bpm": m.bpm_mean}})
+            )
+        else:
+            # Usuario sin Mediciones: se crea una
+            ops.append(
+                UpdateOne(
+                    {"idUsuario": user_oid},
+                    {
+                        "$set": {"valores.bpm": m.bpm_mean},
+                        "$setOnInsert": {"fecha": m.timestamp, "quien_realizo": user_oid},
+                    },
+                    upsert=True,
+                )
+            )
+    updated = created = 0
+    if ops:
+        res_med = await db.Mediciones.bulk_write(ops, ordered=False)
+        updated, created = res_med.modified_count, res_med.upserted_count
+
+    logger.info(f"ECG batch processed. ECG docs: {ecg_inserted}, failed: {len(failed)}, Mediciones updated: {updated}, created: {created}")
+
+    result = {
+        "ecg_inserted": ecg_inserted,
+        "ecg_failed": sorted(failed),
+        "mediciones_updated": updated,
+        "mediciones_created": created,
+    }
+    if failed:
+        # 207: el cliente sabe qué posiciones del lote reintentar (sin duplicar el resto)
+        return MongoJSONResponse(result, status_code=207)
+    return result
@@ -1,14 +1,28 @@
-from fastapi import FastAPI, HTTPException, Body, Request
+from fastapi import FastAPI, HTTPException, Body, Request, Depends, BackgroundTasks, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Optional
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from typing import Annotated, List, Optional
 from datetime import datetime
 import os
+import time
+import asyncio
+import anyio
+import gzip
+import hashlib
+import openai
+import orjson
+from pathlib import Path
 import sys
-import subprocess
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
 import logging
+from dotenv import load_dotenv
+
+load_dotenv()
 
 from .models import (
     UserProfile,
@@ -20,15 +34,40 @@ from .models import (
     RoutineRequest,
     ExerciseInRoutine,
 )
-from .db import get_database
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from .db import (
+    init_db,
+    close_db,
+    get_db,
+    ensure_indexes,
+    telemetry_collection,
+    LOGIN_COLLATION,
+)
 from .ai_engine import SmartBreathingAI
+from .openai_client import SmartBreathingOpenAI, invalidate_user_data
+from .responses import (
+    MongoJSONResponse,
+    NegotiatedGZipMiddleware,
+    accepts_gzip,
+    content_etag,
+    cursor_response,
+    etag_json_response,
+)
 from . import ecg
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="SmartBreathing API", version="0.1.0")
+app = FastAPI(
+    title="SmartBreathing API",
+    version="0.1.0",
+    default_response_class=MongoJSONResponse,
+)
+
+# Comprime las respuestas JSON grandes (listados, señal de ECG)
+app.add_middleware(NegotiatedGZipMiddleware, minimum_size=500)
 
 app.add_middleware(
     CORSMiddleware,
@@ -46,105 +85,173 @@ frontend_dir = os.path.join(project_root, "frontend")
 app.mount("/static", StaticFiles(directory=frontend_dir), name="static")
 
 # HTML Frontend
+# Las páginas se leen una sola vez al arrancar y se sirven desde memoria
+HTML_CACHE_HEADERS = {"Cache-Control": "public, max-age=300"}
+# FRONTEND_CACHE=0 sirve las páginas desde disco para ver los cambios al momento
+FRONTEND_CACHE = os.getenv("FRONTEND_CACHE", "1") != "0"
+
+
+# Rutas absolutas de las páginas, calculadas una vez al importar el módulo
+HTML_PAGES = (
+    "menu.html",
+    "login.html",
+    "index.html",
+    "nuevo_usuario_paso1.html",
+    "nuevo_usuario_paso2.html",
+)
+HTML_PATHS = {name: Path(frontend_dir) / name for name in HTML_PAGES}
+
+
+def load_static_html() -> dict:
+    return {name: path.read_bytes() for name, path in HTML_PATHS.items()}
+
+
+@app.on_event("startup")
+def load_frontend() -> None:
+    app.state.static_html = load_static_html()
+    # Versión gzip precalculada: el middleware no vuelve a comprimir en cada hit
+    app.state.static_html_gzip = {
+        name: gzip.compress(content, compresslevel=9)
+        for name, content in app.state.static_html.items()
+    }
+    # ETag débil: la versión gzip y la plana son la misma página
+    app.state.static_html_etags = {
+        name: f'W/"{hashlib.md5(content).hexdigest()}"'
+        for name, content in app.state.static_html.items()
+    }
+
+
+def html_page(name: str, request: Request) -> Response:
+    if not FRONTEND_CACHE:
+        # Modo desarrollo: se lee del disco en cada petición (sendfile, sin bloquear el loop)
+        return FileResponse(HTML_PATHS[name], media_type="text/html")
+    # ETag por contenido: si el navegador ya tiene la página, 304 sin cuerpo
+    etag = app.state.static_html_etags[name]
+    headers = {**HTML_CACHE_HEADERS, "ETag": etag, "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(content=app.state.static_html_gzip[name], headers=headers)
+    return HTMLResponse(content=app.state.static_html[name], headers=headers)
+
+
+# Una sola ruta para todas las páginas: "/" sirve el menú
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
-    with open(os.path.join(frontend_dir, "menu.html"), "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+@app.get("/{page}.html", response_class=HTMLResponse)
+async def read_page(request: Request, page: str = "menu"):
+    name = f"{page}.html"
+    if name not in HTML_PATHS:
+        raise HTTPException(status_code=404, detail="Página no encontrada")
+    return html_page(name, request)
 
 
-@app.get("/menu.html", response_class=HTMLResponse)
-async def read_menu():
-    with open(os.path.join(frontend_dir, "menu.html"), "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+ai_engine = SmartBreathingAI()
 
 
-@app.get("/login.html", response_class=HTMLResponse)
-async def read_login():
-    with open(os.path.join(frontend_dir, "login.html"), "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+# Hilos para el trabajo síncrono (motor de IA con PyMongo, tareas en segundo plano,
+# sesión de CO2). Las llamadas a la IA pueden tardar: el límite por defecto de anyio (40)
+# se queda corto con varias rutinas en paralelo.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
 
 
-@app.get("/index.html", response_class=HTMLResponse)
-async def read_index():
-    with open(os.path.join(frontend_dir, "index.html"), "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+@app.on_event("startup")
+async def configure_threadpool() -> None:
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
 
 
-@app.get("/nuevo_usuario_paso1.html", response_class=HTMLResponse)
-async def read_nuevo_usuario_paso1():
-    with open(os.path.join(frontend_dir, "nuevo_usuario_paso1.html"), "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+@app.on_event("startup")
+async def startup_db() -> None:
+    await init_db(app)
+    try:
+        await ensure_indexes(app.state.db)
+    except Exception as e:
+        logger.error(f"Error creating MongoDB indexes: {e}")
 
 
-@app.get("/nuevo_usuario_paso2.html", response_class=HTMLResponse)
-async def read_nuevo_usuario_paso2():
-    with open(os.path.join(frontend_dir, "nuevo_usuario_paso2.html"), "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+@app.on_event("startup")
+async def create_indexes() -> None:
+    # PyMongo síncrono: fuera del event loop para no bloquear el arranque
+    await run_in_threadpool(ai_engine.ensure_indexes)
 
 
-ai_engine = SmartBreathingAI()
+@app.on_event("shutdown")
+async def shutdown_db() -> None:
+    await close_db()
 
 # Register routers
 app.include_router(ecg.router, prefix="/api", tags=["ecg"])
 
 
+# Respuesta precalculada: el health check se sondea a menudo y no necesita
+# pasar por la serialización de FastAPI
+HEALTH_RESPONSE_BODY = b'{"status":"ok"}'
+
+
 @app.get("/health")
-def health_check() -> dict:
-    return {"status": "ok"}
+def health_check() -> Response:
+    return Response(content=HEALTH_RESPONSE_BODY, media_type="application/json")
 
 
 # --- USERS ---
 @app.post("/api/users/", response_model=UserProfile)
-async def create_user(user: UserProfile):
-    db = get_database()
-    result = db.users.insert_one(user.dict(by_alias=True))
-    user.id = result.inserted_id
-    return user
+async def create_user(user: UserProfile, db: AsyncIOMotorDatabase = Depends(get_db)):
+    doc = user.model_dump(by_alias=True)
+    # No se guardan campos vacíos (p. ej. telegram_id en usuarios web)
+    result = await db.users.insert_one({k: v for k, v in doc.items() if v is not None})
+    # Se devuelve el mismo dump que se ha escrito: sin volver a validar contra response_model
+    doc["_id"] = result.inserted_id
+    return MongoJSONResponse(doc)
 
 
 @app.get("/api/users/{telegram_id}", response_model=UserProfile)
-async def get_user_by_telegram(telegram_id: int):
-    db = get_database()
-    user_data = db.users.find_one({"telegram_id": telegram_id})
+async def get_user_by_telegram(
+    telegram_id: int,
+    request: Request,
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
+    user_data = await db.users.find_one({"telegram_id": telegram_id})
     if not user_data:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    user_data["_id"] = str(user_data["_id"])
-    return user_data
+    # Misma salida que response_model (por alias), con ETag. El ETag sale del documento
+    # guardado: los valores por defecto del modelo (p. ej. updated_at) cambian en cada llamada
+    user = UserProfile.model_validate(user_data).model_dump(mode="json", by_alias=True)
+    return etag_json_response(request, user, etag=content_etag(user_data))
 
 
 @app.post("/api/users/check_duplicate")
-async def check_duplicate_user(datos: dict = Body(...)):
-    db = get_database()
+async def check_duplicate_user(
+    datos: dict = Body(...),
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
     nombre = datos.get("nombre", "").strip()
     apellido = datos.get("apellido", "").strip()
     codigo = datos.get("codigo", "").strip()
 
-    usuario = db.users.find_one(
-        {
-            "nombre": {"$regex": f"^{nombre}$", "$options": "i"},
-            "apellido": {"$regex": f"^{apellido}$", "$options": "i"},
-            "codigo": codigo,
-        }
+    # Igualdad con la collation del índice users_login (sin regex: IXSCAN, no COLLSCAN).
+    # Solo importa si existe: el conteo se resuelve en el índice sin leer el documento
+    count = await db.users.count_documents(
+        {"codigo": codigo, "nombre": nombre, "apellido": apellido},
+        limit=1,
+        collation=LOGIN_COLLATION,
     )
-
-    if usuario:
-        return {"exists": True}
-    return {"exists": False}
+    return {"exists": count > 0}
 
 
 @app.post("/api/users/create")
-async def create_new_user(user: UserCreate):
-    db = get_database()
+async def create_new_user(user: UserCreate, db: AsyncIOMotorDatabase = Depends(get_db)):
     # Se elimina la comprobación de unicidad del código
-    new_user_data = user.dict()
+    new_user_data = user.model_dump()
     # Se mantiene 'peso' en new_user_data para guardarlo también en la colección users
-    new_user_data["created_at"] = datetime.utcnow()
-    new_user_data["updated_at"] = datetime.utcnow()
+    # Un solo reloj para ambos campos: mismo instante de creación y actualización
+    now = datetime.utcnow()
+    new_user_data["created_at"] = now
+    new_user_data["updated_at"] = now
     if "genero" not in new_user_data or not new_user_data["genero"]:
         raise HTTPException(
             status_code=400, detail="El campo 'genero' es obligatorio."
         )
-    result = db.users.insert_one(new_user_data)
+    result = await db.users.insert_one(new_user_data)
     if not result.inserted_id:
         raise HTTPException(
             status_code=500, detail="No se pudo crear el usuario."
@@ -156,68 +263,63 @@ async def create_new_user(user: UserCreate):
     }
 
 
+# Campos que necesita el listado; el resto del perfil no viaja por la red
+USER_LIST_FIELDS = {"nombre": 1, "apellido": 1, "codigo": 1}
+
+
 @app.get("/api/users/list")
-async def list_users():
-    db = get_database()
-    usuarios = list(db.users.find())
-    for usuario in usuarios:
-        usuario["_id"] = str(usuario["_id"])
-    return usuarios
+async def list_users(db: AsyncIOMotorDatabase = Depends(get_db)):
+    cursor = db.users.find({}, projection=USER_LIST_FIELDS)
+    # Se envía en streaming según llegan los documentos (orjson, ObjectId -> str)
+    return cursor_response(cursor)
 
 
 @app.get("/api/users/by_id/{user_id}")
-async def get_user_by_id(user_id: str):
+async def get_user_by_id(
+    user_id: str,
+    request: Request,
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
     try:
-        db = get_database()
-        user = db.users.find_one({"_id": ObjectId(user_id)})
-        if not user:
-            raise HTTPException(status_code=404, detail="Usuario no encontrado")
-        user["_id"] = str(user["_id"])
-        return user
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"Error al obtener usuario: {str(e)}"
-        )
+        obj_id = ObjectId(user_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Formato de user_id incorrecto")
+    user = await db.users.find_one({"_id": obj_id})
+    if not user:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    return etag_json_response(request, user)
 
 
 # --- CO2 SESSION DATA ---
 @app.get("/api/co2/last-session/{user_id}")
-async def get_last_co2_session(user_id: str):
-    db = get_database()
+async def get_last_co2_session(
+    user_id: str,
+    request: Request,
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
     try:
-        # Try to find user by string id or ObjectId
-        query = {"idUsuario": user_id}
-        # Ideally we should match the format stored. 
-        # In ingestion/read_co2_scd30.py, it attempts to store ObjectId if possible, else string.
-        # We can try both.
-        
-        # Check if there is any doc with string id
-        doc = db.co2.find_one({"idUsuario": user_id}, sort=[("fecha", -1)])
-        
-        if not doc:
-            # Try ObjectId
-            try:
-                oid = ObjectId(user_id)
-                doc = db.co2.find_one({"idUsuario": oid}, sort=[("fecha", -1)])
-            except Exception:
-                pass
-        
+        # idUsuario puede estar guardado como ObjectId o como string
+        # (ingestion/read_co2_scd30.py guarda ObjectId si puede): una sola consulta
+        # con $in sobre el índice (idUsuario, fecha) en lugar de dos. Sin hint: si el
+        # índice faltara, la consulta sigue funcionando en vez de fallar con 500
+        ids = [user_id]
+        if ObjectId.is_valid(user_id):
+            ids.insert(0, ObjectId(user_id))
+        doc = await db.co2.find_one(
+            {"idUsuario": {"$in": ids}},
+            sort=[("fecha", -1)],
+        )
+
         if not doc:
             # Return empty structure or 404? 
             # Frontend expects JSON to plot. returning 404 might be easier to handle "No data".
             raise HTTPException(status_code=404, detail="No CO2 session found")
 
-        # Convert doc to JSON-safe
-        doc["_id"] = str(doc["_id"])
-        doc["idUsuario"] = str(doc["idUsuario"])
-        if "fecha" in doc and isinstance(doc["fecha"], datetime):
-             doc["fecha"] = doc["fecha"].isoformat()
-
         # Ensure indices_estabilizados is present (null if missing in legacy data)
-        if "indices_estabilizados" not in doc:
-             doc["indices_estabilizados"] = None
+        doc.setdefault("indices_estabilizados", None)
 
-        return doc
+        # Las sesiones no se modifican tras insertarse: el _id basta como ETag
+        return etag_json_response(request, doc, etag=str(doc["_id"]))
 
     except HTTPException:
         raise
@@ -226,16 +328,136 @@ async def get_last_co2_session(user_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Tope de documentos por listado. $limit debe ser positivo, y el error saldría a mitad
+# del stream (200 y "[" ya enviados): se valida antes de construir el pipeline
+LIST_LIMIT_MAX = 1000
+
+
+# --- SENSOR READINGS ---
+def persist_recommendations(readings_by_user: dict) -> None:
+    """
+    Analiza las lecturas de cada usuario y guarda sus recomendaciones.
+    Se ejecuta como tarea en segundo plano (threadpool), fuera de la petición.
+    """
+    try:
+        recommendations = [
+            ai_engine.generate_recommendation(
+                user_id, ai_engine.analyze_physiological_data(user_id, user_readings)
+            )
+            for user_id, user_readings in readings_by_user.items()
+        ]
+        ai_engine.db.recommendations.insert_many(
+            [rec.model_dump(by_alias=True, exclude_none=True) for rec in recommendations],
+            ordered=False,
+        )
+    except Exception as e:
+        logger.error(f"Error generating recommendations: {e}", exc_info=True)
+
+
+def sensor_reading_doc(reading: SensorReading) -> dict:
+    # Sin los campos opcionales vacíos (ecg_data, temperature...) en cada documento.
+    # _id y user_id se guardan como str (PyObjectId se serializa así): ver
+    # SENSOR_READING_LIST_FIELDS
+    doc = reading.model_dump(by_alias=True, exclude_none=True)
+    if reading.ecg_data:
+        # Mismo empaquetado int16 + escala que la colección ecg (~4x menos que doubles)
+        doc["ecg_data"], doc["ecg_scale"] = ecg._pack_signal(reading.ecg_data)
+        doc["ecg_dtype"] = "int16"
+    return doc
+
+
+@app.post("/api/sensors/readings")
+async def create_sensor_readings(
+    readings: List[SensorReading],
+    background_tasks: BackgroundTasks,
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
+    """
+    Inserta un lote de lecturas en una sola operación y responde en cuanto
+    se guardan; las recomendaciones por usuario se generan en segundo plano.
+    """
+    if not readings:
+        raise HTTPException(status_code=400, detail="No se han enviado lecturas")
+
+    docs = [sensor_reading_doc(r) for r in readings]
+    try:
+        # ordered=False: una lectura inválida no aborta el resto del lote
+        result = await telemetry_collection(db, "sensor_readings").insert_many(
+            docs, ordered=False
+        )
+        inserted = len(result.inserted_ids)
+    except BulkWriteError as e:
+        logger.error(f"Error inserting sensor readings: {e.details.get('writeErrors')}")
+        inserted = e.details.get("nInserted", 0)
+
+    readings_by_user = {}
+    for r in readings:
+        readings_by_user.setdefault(str(r.user_id), []).append(r)
+    # Los análisis de IA de estos usuarios ya no deben reutilizar las lecturas en caché
+    invalidate_user_data(readings_by_user)
+    background_tasks.add_task(persist_recommendations, readings_by_user)
+
+    return {"inserted": inserted, "users": len(readings_by_user)}
+
+
 # --- MEDICIONES ---
+# Claves que solo escribe la ingesta de CO2 (read_co2_scd30.py)
+INGESTION_ONLY_KEYS = frozenset(
+    [f"co2_{i}" for i in range(1, 6)] + [f"hum_{i}" for i in range(1, 6)]
+)
+
+
+# En sensor_readings, _id y user_id son str de 24 caracteres, no ObjectId: así los
+# escribe sensor_reading_doc y así los consultan los lectores de IA (ai_engine,
+# openai_client, ai_batches) desde siempre. Cualquier $match por usuario usa el str.
+# Lecturas para listados: sin la señal ECG empaquetada
+SENSOR_READING_LIST_FIELDS = {
+    "_id": 1,
+    "user_id": 1,
+    "timestamp": 1,
+    "spo2": 1,
+    "co2": 1,
+    "heart_rate": 1,
+    "temperature": 1,
+    "respiratory_rate": 1,
+}
+
+
+@app.get("/api/sensors/readings/{user_id}")
+async def get_sensor_readings(
+    user_id: str,
+    limit: Annotated[int, Query(ge=1, le=LIST_LIMIT_MAX)] = 100,
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
+    try:
+        # Forma canónica (hex en minúsculas), la misma que escribe sensor_reading_doc
+        user_id = str(ObjectId(user_id))
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    cursor = db.sensor_readings.aggregate(
+        [
+            # user_id se guarda como str (ver SENSOR_READING_LIST_FIELDS)
+            {"$match": {"user_id": user_id}},
+            {"$sort": {"timestamp": -1}},
+            {"$limit": limit},
+            {"$project": SENSOR_READING_LIST_FIELDS},
+        ]
+    )
+    # Documentos planos serializados con orjson, sin pasar por SensorReading
+    return cursor_response(cursor)
+
+
 @app.post("/api/mediciones")
-async def create_or_update_medicion(request: Request):
-    db = get_database()
+async def create_or_update_medicion(
+    request: Request,
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
     data = await request.json()
 
     idUsuario = data.get("idUsuario")
     nuevos_valores = data.get("valores", {})
     fecha = data.get("fecha", datetime.utcnow().isoformat())
-    quien_realizo = data.get("quien_realizo", idUsuario)
+    quien_realizo = data.get("quien_realizo")
 
     if not idUsuario or not isinstance(nuevos_valores, dict):
         raise HTTPException(
@@ -250,172 +472,296 @@ async def create_or_update_medicion(request: Request):
             status_code=400, detail="Formato de idUsuario incorrecto"
         )
 
-    existing = db.Mediciones.find_one({"idUsuario": obj_idUsuario})
-
-    if existing:
-        # Prevent overwriting CO2/Humidity fields from automated ingestion
-        forbidden_keys = [f"co2_{i}" for i in range(1, 6)] + [f"hum_{i}" for i in range(1, 6)]
-        for k in forbidden_keys:
-            nuevos_valores.pop(k, None)
-
-        dict_actual = existing.get("valores", {})
-        dict_actual.update(nuevos_valores)
-        db.Mediciones.update_one(
-            {"_id": existing["_id"]},
-            {
-                "$set": {
-                    "valores": dict_actual,
-                    "fecha": fecha,
-                    "quien_realizo": quien_realizo,
-                }
-            },
-        )
-        resultado = db.Mediciones.find_one({"_id": existing["_id"]})
-        resultado["_id"] = str(resultado["_id"])
-        if "idUsuario" in resultado:
-            resultado["idUsuario"] = str(resultado["idUsuario"])
-        if "quien_realizo" in resultado and isinstance(
-            resultado["quien_realizo"], ObjectId
-        ):
-            resultado["quien_realizo"] = str(resultado["quien_realizo"])
-        return resultado
-    else:
-        medicion = {
-            "idUsuario": obj_idUsuario,
-            "valores": nuevos_valores,
-            "fecha": fecha,
-            "quien_realizo": obj_idUsuario,
-        }
-        result = db.Mediciones.insert_one(medicion)
-        medicion["_id"] = str(result.inserted_id)
-        medicion["idUsuario"] = str(medicion["idUsuario"])
-        if isinstance(medicion.get("quien_realizo"), ObjectId):
-            medicion["quien_realizo"] = str(medicion["quien_realizo"])
-        return medicion
+    # Una sola operación atómica: $set por clave dentro de 'valores' (no se
+    # reescribe el subdocumento entero ni se pisan claves de otros escritores).
+    # Los campos de CO2/humedad de la ingesta automática solo se escriben al
+    # crear el documento; en uno existente no se sobrescriben.
+    set_ops = {}
+    set_on_insert = {}
+    for k, v in nuevos_valores.items():
+        if k in INGESTION_ONLY_KEYS:
+            set_on_insert[f"valores.{k}"] = v
+        else:
+            set_ops[f"valores.{k}"] = v
+    set_ops["fecha"] = fecha
+    if quien_realizo in (None, idUsuario):
+        quien_realizo = obj_idUsuario
+    set_ops["quien_realizo"] = quien_realizo
+
+    update = {"$set": set_ops}
+    if set_on_insert:
+        update["$setOnInsert"] = set_on_insert
+
+    resultado = await db.Mediciones.find_one_and_update(
+        {"idUsuario": obj_idUsuario},
+        update,
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return MongoJSONResponse(resultado)
+
+
+# Campos que devuelve el listado de mediciones (el resto no sale de MongoDB)
+MEDICION_FIELDS = {"valores": 1, "fecha": 1, "idUsuario": 1, "quien_realizo": 1}
+MEDICION_ID_AS_STRING = {
+    "_id": {"$toString": "$_id"},
+    # idUsuario siempre existe: es el campo del $match
+    "idUsuario": {"$toString": "$idUsuario"},
+    # quien_realizo es opcional: si falta, $toString daría null; se deja sin clave
+    "quien_realizo": {
+        "$cond": [
+            {"$eq": [{"$type": "$quien_realizo"}, "missing"]},
+            "$$REMOVE",
+            {"$toString": "$quien_realizo"},
+        ]
+    },
+}
 
 
 @app.get("/api/mediciones")
-async def get_all_mediciones(user_id: str, limit: int = 100):
-    db = get_database()
+async def get_all_mediciones(
+    user_id: str,
+    limit: Annotated[int, Query(ge=1, le=LIST_LIMIT_MAX)] = 100,
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
     try:
         obj_user_id = ObjectId(user_id)
     except Exception:
         return []
-    mediciones = list(
-        db.Mediciones.find(
-            {"idUsuario": obj_user_id}, sort=[("fecha", -1)], limit=limit
-        )
+    cursor = db.Mediciones.aggregate(
+        [
+            {"$match": {"idUsuario": obj_user_id}},
+            {"$sort": {"fecha": -1}},
+            {"$limit": limit},
+            {"$project": MEDICION_FIELDS},
+            # Los ObjectId se convierten a str en el servidor: documentos listos para JSON
+            {"$addFields": MEDICION_ID_AS_STRING},
+        ],
     )
-    for m in mediciones:
-        m["_id"] = str(m["_id"])
-        if "idUsuario" in m:
-            m["idUsuario"] = str(m["idUsuario"])
-        if "quien_realizo" in m and isinstance(
-            m["quien_realizo"], ObjectId
-        ):
-            m["quien_realizo"] = str(m["quien_realizo"])
-    return mediciones
+    # Se envía en streaming según llegan los documentos (sin hint: un índice ausente
+    # haría fallar el cursor con la respuesta 200 ya empezada)
+    return cursor_response(cursor)
 
 
 # -------------- LOGIN --------------
+# --- SESIONES DE CO2 ---
+# La ingesta sigue siendo un proceso aparte (pyserial, bucle bloqueante sobre el puerto
+# serie), pero se lanza desde una cola con un único worker: fuera del camino del login
+# y sin dos sesiones peleándose por el mismo puerto. Si una sesión supera
+# CO2_SESSION_TIMEOUT, recibe SIGTERM para que el script guarde lo medido.
+CO2_INGESTION_SCRIPT = os.path.join(project_root, "ingestion", "read_co2_scd30.py")
+CO2_SESSION_TIMEOUT = int(os.getenv("CO2_SESSION_TIMEOUT", "900"))
+# Margen para que el script cierre la sesión tras SIGTERM antes de forzarlo
+CO2_SESSION_STOP_GRACE = 30
+
+
+async def stop_co2_process(process: asyncio.subprocess.Process) -> None:
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), CO2_SESSION_STOP_GRACE)
+    except asyncio.TimeoutError:
+        logger.error(f"CO2 session process {process.pid} ignored SIGTERM, killing it")
+        process.kill()
+        await process.wait()
+
+
+async def run_co2_session(user_id_str: str) -> None:
+    if not os.path.exists(CO2_INGESTION_SCRIPT):
+        logger.error(f"Ingestion script not found at {CO2_INGESTION_SCRIPT}")
+        return
+    cmd = [sys.executable, CO2_INGESTION_SCRIPT, "--user-id", user_id_str, "--session"]
+    logger.info(f"Launching CO2 session command: {cmd}")
+    # stdout/stderr heredados → veo logs en la consola
+    process = await asyncio.create_subprocess_exec(*cmd, start_new_session=True)
+    try:
+        await asyncio.wait_for(process.wait(), CO2_SESSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"CO2 session for user {user_id_str} timed out, stopping it")
+        await stop_co2_process(process)
+    except asyncio.CancelledError:
+        # Apagado del servidor: se cierra la sesión guardando lo medido
+        await stop_co2_process(process)
+        raise
+
+
+async def co2_session_worker(queue: asyncio.Queue, pending: set) -> None:
+    while True:
+        user_id_str = await queue.get()
+        try:
+            logger.info(f"Starting CO2 session for user {user_id_str}")
+            await run_co2_session(user_id_str)
+        except Exception as e:
+            logger.error(f"Failed to start CO2 session: {e}")
+        finally:
+            pending.discard(user_id_str)
+            queue.task_done()
+
+
+def enqueue_co2_session(user_id_str: str) -> None:
+    # Un usuario que repite el login mientras su sesión espera o está en marcha
+    # no encola otra: ya hay un lector del SCD30 para él
+    if user_id_str in app.state.co2_pending:
+        logger.info(f"CO2 session for user {user_id_str} already queued or running")
+        return
+    app.state.co2_pending.add(user_id_str)
+    app.state.co2_sessions.put_nowait(user_id_str)
+
+
+@app.on_event("startup")
+async def start_co2_worker() -> None:
+    app.state.co2_sessions = asyncio.Queue()
+    app.state.co2_pending = set()
+    app.state.co2_worker = asyncio.create_task(
+        co2_session_worker(app.state.co2_sessions, app.state.co2_pending)
+    )
+
+
+@app.on_event("shutdown")
+async def stop_co2_worker() -> None:
+    # La cancelación llega a run_co2_session, que para la sesión en curso con SIGTERM
+    app.state.co2_worker.cancel()
+    await asyncio.gather(app.state.co2_worker, return_exceptions=True)
+
+
 @app.post("/api/check_user")
-async def check_user(datos: dict = Body(...)):
-    db = get_database()
+async def check_user(
+    datos: dict = Body(...),
+    db: AsyncIOMotorDatabase = Depends(get_db),
+):
     nombre = datos.get("nombre", "").strip()
     apellido = datos.get("apellido", "").strip()
     codigo = datos.get("codigo", "").strip()
-    usuario = db.users.find_one(
-        {
-            "nombre": {"$regex": f"^{nombre}$", "$options": "i"},
-            "apellido": {"$regex": f"^{apellido}$", "$options": "i"},
-            "codigo": codigo,
-        }
+    usuario = await db.users.find_one(
+        {"codigo": codigo, "nombre": nombre, "apellido": apellido},
+        projection={"_id": 1},
+        collation=LOGIN_COLLATION,
     )
     if not usuario:
         raise HTTPException(
             status_code=404, detail="Usuario no existente, regístrese"
         )
     
-    # Start CO2 measurement session in background
-    try:
-        user_id_str = str(usuario["_id"])
-        ingestion_script = os.path.join(project_root, "ingestion", "read_co2_scd30.py")
-        
-        # Ensure the script exists before trying to run it
-        if os.path.exists(ingestion_script):
-            logger.info(f"Starting CO2 session for user {user_id_str}")
-            cmd = [sys.executable, ingestion_script, "--user-id", user_id_str, "--session"]
-            logger.info(f"Launching CO2 session command: {cmd}")
-            subprocess.Popen(
-                cmd,
-                stdout=None,   # hereda stdout/stderr → veo logs en la consola
-                stderr=None,
-                start_new_session=True
-            )
-        else:
-            logger.error(f"Ingestion script not found at {ingestion_script}")
-    except Exception as e:
-        logger.error(f"Failed to start CO2 session: {e}")
+    # La sesión de CO2 se encola: el login responde sin esperar al arranque del proceso
+    enqueue_co2_session(str(usuario["_id"]))
 
     return {"user_id": str(usuario["_id"])}
 
 
+# -------------- AI ANALYSIS --------------
+@app.get("/api/analysis/{user_id}/stream")
+def stream_physiology_analysis(user_id: str, hours: int = 2):
+    """
+    Análisis fisiológico con ChatGPT en NDJSON: una línea por análisis parcial según
+    llegan los tokens y la última con el análisis completo (ya guardado).
+    """
+    try:
+        analyzer = SmartBreathingOpenAI()
+    except openai.OpenAIError as e:
+        logger.error(f"OpenAI client not available: {e}")
+        raise HTTPException(status_code=503, detail="Servicio de IA no configurado")
+
+    parts = analyzer.analyze_user_physiology_stream(user_id, hours)
+
+    async def lines():
+        # El generador es síncrono (PyMongo/OpenAI bloqueantes): se recorre en el threadpool
+        try:
+            async for part in iterate_in_threadpool(parts):
+                yield orjson.dumps(part, default=str) + b"\n"
+        finally:
+            # Cliente desconectado: se cierra el stream de OpenAI y se libera su slot ya
+            parts.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 # -------------- AI ROUTINE --------------
+# Perfiles validados por user_id durante unos segundos: las llamadas seguidas a la IA
+# (rutina, alternativas) no repiten la consulta ni la validación de Pydantic.
+# El bot actualiza los usuarios directamente en Mongo, así que el TTL acota el desfase.
+USER_PROFILE_TTL = 60
+USER_PROFILE_CACHE_SIZE = 1024
+_user_profile_cache: dict = {}
+
+
+async def load_user_profile(db: AsyncIOMotorDatabase, user_id: str) -> UserProfile:
+    cached = _user_profile_cache.get(user_id)
+    if cached and time.monotonic() - cached[0] < USER_PROFILE_TTL:
+        return cached[1]
+
+    try:
+        obj_id = ObjectId(user_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid user_id format")
+
+    user_doc = await db.users.find_one({"_id": obj_id})
+    if not user_doc:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    user_profile = UserProfile.model_validate(user_doc)
+    _user_profile_cache.pop(user_id, None)
+    if len(_user_profile_cache) >= USER_PROFILE_CACHE_SIZE:
+        # Se descarta la entrada más antigua (los dict mantienen el orden de inserción)
+        _user_profile_cache.pop(next(iter(_user_profile_cache)))
+    _user_profile_cache[user_id] = (time.monotonic(), user_profile)
+    return user_profile
+
+
+async def generate_routine_or_none(
+    user_profile: UserProfile, goals: List[str]
+) -> Optional[RoutineResponse]:
+    # El motor de IA usa PyMongo síncrono: se ejecuta fuera del event loop
+    try:
+        return await run_in_threadpool(
+            ai_engine.generate_routine_from_db, user_profile, goals
+        )
+    except Exception as e:
+        logger.error(
+            "Error generating routine from DB (goals=%s): %s",
+            goals,
+            str(e),
+            exc_info=True,
+        )
+        return None
+
+
 @app.post(
     "/api/ai/alternative-exercise/{user_id}", response_model=Optional[ExerciseInRoutine]
 )
 async def get_alternative_exercise_endpoint(
     user_id: str,
-    raw_request: Request,
     request: dict = Body(...), # expects {"exercise_id": "..."}
+    db: AsyncIOMotorDatabase = Depends(get_db),
 ):
     """
     Returns an alternative exercise for a given exercise ID, matching properties.
+    Returns null (200) when no alternative is found.
     """
-    try:
-        exercise_id = request.get("exercise_id")
-        if not exercise_id:
-            raise HTTPException(status_code=400, detail="Missing exercise_id")
-
-        # 1. Fetch User
-        db = get_database()
-        try:
-            obj_id = ObjectId(user_id)
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid user_id format")
-
-        user_doc = db.users.find_one({"_id": obj_id})
-        if not user_doc:
-            raise HTTPException(status_code=404, detail="User not found")
+    exercise_id = request.get("exercise_id")
+    if not exercise_id:
+        raise HTTPException(status_code=400, detail="Missing exercise_id")
 
-        user_profile = UserProfile(**user_doc)
+    # 1. Fetch User
+    user_profile = await load_user_profile(db, user_id)
 
-        # 2. Get Alternative
-        alt_exercise = ai_engine.get_alternative_exercise(user_profile, exercise_id)
-        
-        if not alt_exercise:
-            # Fallback or just 404/Null? Let's return null/none to indicate no alternative found
-            # But client might expect JSON. 
-            # Returning 404 might be handled as error. 
-            # Returning None (200 OK with null body) is often safer for logic.
-            return None
-
-        return alt_exercise
-
-    except HTTPException:
-        raise
+    # 2. Get Alternative
+    try:
+        alt_exercise = await run_in_threadpool(
+            ai_engine.get_alternative_exercise, user_profile, exercise_id
+        )
     except Exception as e:
         logger.error(f"Error getting alternative exercise: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+    return alt_exercise or None
+
 
 @app.post(
     "/api/ai/generate-routine/{user_id}", response_model=RoutineResponse
 )
 async def generate_routine_endpoint(
     user_id: str,
-    raw_request: Request,
     request: RoutineRequest | None = Body(None),
+    db: AsyncIOMotorDatabase = Depends(get_db),
 ):
     """
     Genera una rutina para un usuario dado.
@@ -424,91 +770,40 @@ async def generate_routine_endpoint(
       en ese caso intenta un fallback con ["mixto"] y, si sigue sin haber nada,
       lanza un 500 con mensaje claro.
     """
-    try:
-        # Debug del body crudo para ver exactamente qué llega
-        body_bytes = await raw_request.body()
-        logger.info(
-            "DEBUG generate-routine raw body: %s",
-            body_bytes.decode("utf-8") if body_bytes else "<empty>",
-        )
+    goals = request.goals if request and request.goals else ["mixto"]
+    logger.info("generate-routine goals: %s", goals)
 
-        goals = request.goals if request and request.goals else ["mixto"]
-        logger.info("generate-routine goals: %s", goals)
+    # 1. Usuario
+    user_profile = await load_user_profile(db, user_id)
 
-        # 1. Fetch User
-        db = get_database()
-        try:
-            obj_id = ObjectId(user_id)
-        except Exception:
-            raise HTTPException(
-                status_code=400, detail="Invalid user_id format"
-            )
-
-        user_doc = db.users.find_one({"_id": obj_id})
-        if not user_doc:
-            raise HTTPException(status_code=404, detail="User not found")
+    # 2. Intento principal: goals tal cual vienen
+    routine = await generate_routine_or_none(user_profile, goals)
 
-        user_profile = UserProfile(**user_doc)
-
-        # 2. Intento principal: goals tal cual vienen
-        try:
-            routine = ai_engine.generate_routine_from_db(
-                user_profile, goals
-            )
-        except Exception as e_gen:
-            logger.error(
-                "Error generating routine from DB (goals=%s): %s",
-                goals,
-                str(e_gen),
-                exc_info=True,
-            )
-            routine = None
-
-        # 3. Si no hay ejercicios, intentamos fallback con ["mixto"]
-        if not routine or not getattr(routine, "exercises", None):
-            if goals != ["mixto"]:
-                logger.warning(
-                    "No exercises found with goals=%s, trying fallback ['mixto']",
-                    goals,
-                )
-                try:
-                    fallback_routine = ai_engine.generate_routine_from_db(
-                        user_profile, ["mixto"]
-                    )
-                    if fallback_routine and getattr(
-                        fallback_routine, "exercises", None
-                    ):
-                        routine = fallback_routine
-                except Exception as e_fallback:
-                    logger.error(
-                        "Error generating fallback routine (['mixto']): %s",
-                        str(e_fallback),
-                        exc_info=True,
-                    )
-
-        # 4. Si aun así no hay ejercicios, esto ya es un problema interno
-        if not routine or not getattr(routine, "exercises", None):
-            logger.error(
-                "No exercises available even after fallback for user %s",
-                user_id,
-            )
-            raise HTTPException(
-                status_code=500,
-                detail=(
-                    "No hay ejercicios disponibles en la base de datos "
-                    "para generar una rutina con los filtros actuales."
-                ),
-            )
-
-        return routine
+    # 3. Si no hay ejercicios, intentamos fallback con ["mixto"]
+    if not getattr(routine, "exercises", None) and goals != ["mixto"]:
+        logger.warning(
+            "No exercises found with goals=%s, trying fallback ['mixto']",
+            goals,
+        )
+        routine = await generate_routine_or_none(user_profile, ["mixto"])
 
-    except HTTPException:
-        # Re-lanzamos HTTPException tal cual
-        raise
-    except Exception as e:
+    # 4. Si aun así no hay ejercicios, esto ya es un problema interno
+    if not getattr(routine, "exercises", None):
         logger.error(
-            "Error in generate_routine_endpoint: %s", str(e), exc_info=True
+            "No exercises available even after fallback for user %s",
+            user_id,
         )
         raise HTTPException(
-            status_code=500, detail=f"Internal error: {str(e)}"
+            status_code=500,
+            detail=(
+                "No hay ejercicios disponibles en la base de datos "
+                "para generar una rutina con los filtros actuales."
+            ),
         )
+
+    return routine
+
+
+# Resto del frontend (css/, js/, datos.json) en la raíz, para que las rutas
+# relativas de las páginas resuelvan. Va al final: las rutas de arriba tienen prioridad
+app.mount("/", StaticFiles(directory=frontend_dir, html=True), name="frontend")
@@ -1,7 +1,9 @@
-from datetime import datetime
+import re
+from datetime import datetime, timezone
 from typing import Optional, List, Dict, Any
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from bson import ObjectId
+from bson.errors import InvalidId
 from pydantic_core import core_schema
 
 class PyObjectId(ObjectId):
@@ -9,18 +11,36 @@ class PyObjectId(ObjectId):
     def __get_pydantic_core_schema__(
         cls, source_type: Any, handler: Any
     ) -> core_schema.CoreSchema:
+        # Sin memoizar: Pydantic escribe en el schema devuelto (metadata de Annotated, p. ej.
+        # WithJsonSchema), y uno compartido arrastraría eso a todos los campos PyObjectId
         return core_schema.json_or_python_schema(
             python_schema=core_schema.with_info_plain_validator_function(cls.validate),
             json_schema=core_schema.str_schema(),
-            serialization=core_schema.plain_serializer_function_ser_schema(lambda x: str(x)),
+            serialization=core_schema.plain_serializer_function_ser_schema(str),
         )
 
     @classmethod
     def validate(cls, v: Any, *args, **kwargs) -> ObjectId:
-        if ObjectId.is_valid(v):
-            return ObjectId(v)
+        if isinstance(v, ObjectId):
+            return v
+        if isinstance(v, (bytes, bytearray)) and len(v) == 12:
+            return ObjectId(bytes(v))
+        if isinstance(v, str) and len(v) == 24:
+            try:
+                return ObjectId(v)
+            except InvalidId:
+                pass
         raise ValueError("Invalid ObjectId")
 
+# PIN de acceso: exactamente 4 dígitos ASCII
+PIN_RE = re.compile(r"[0-9]{4}")
+
+# Config común (Pydantic v2) de los modelos con _id de Mongo; PyObjectId ya se serializa como str
+MONGO_MODEL_CONFIG = ConfigDict(populate_by_name=True, arbitrary_types_allowed=True)
+# Objetos de valor que no se modifican tras crearse (lecturas, recomendaciones)
+MONGO_VALUE_CONFIG = ConfigDict(**MONGO_MODEL_CONFIG, frozen=True)
+
+
 class UserProfile(BaseModel):
     id: Optional[PyObjectId] = Field(default_factory=PyObjectId, alias="_id")
     telegram_id: Optional[int] = None
@@ -42,10 +62,7 @@ class UserProfile(BaseModel):
     sistema_recompensas: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
-    class Config:
-        populate_by_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    model_config = MONGO_MODEL_CONFIG
 
 class UserCreate(BaseModel):
     nombre: str
@@ -55,7 +72,7 @@ class UserCreate(BaseModel):
     @field_validator('codigo')
     @classmethod
     def validate_codigo(cls, v: str) -> str:
-        if not v.isdigit() or len(v) != 4:
+        if not PIN_RE.fullmatch(v):
             raise ValueError('El código debe ser un PIN de 4 dígitos numéricos')
         return v
 
@@ -82,10 +99,9 @@ class SensorReading(BaseModel):
     ecg_data: Optional[List[float]] = None
     temperature: Optional[float] = None
     respiratory_rate: Optional[float] = None
-    class Config:
-        populate_by_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    # NaN/±inf se rechazan con 422: ecg_data no se podría empaquetar a int16
+    model_config = ConfigDict(**MONGO_VALUE_CONFIG, allow_inf_nan=False)
+
 
 class Exercise(BaseModel):
     id: Optional[PyObjectId] = Field(default_factory=PyObjectId, alias="_id")
@@ -97,10 +113,7 @@ class Exercise(BaseModel):
     target_muscles: List[str]
     instructions: List[str]
     created_at: datetime = Field(default_factory=datetime.utcnow)
-    class Config:
-        populate_by_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    model_config = MONGO_MODEL_CONFIG
 
 class WorkoutRoutine(BaseModel):
     id: Optional[PyObjectId] = Field(default_factory=PyObjectId, alias="_id")
@@ -113,10 +126,7 @@ class WorkoutRoutine(BaseModel):
     target_goals: List[str]
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_active: bool = True
-    class Config:
-        populate_by_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    model_config = MONGO_MODEL_CONFIG
 
 class AIRecommendation(BaseModel):
     id: Optional[PyObjectId] = Field(default_factory=PyObjectId, alias="_id")
@@ -127,10 +137,7 @@ class AIRecommendation(BaseModel):
     based_on_metrics: dict
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_applied: bool = False
-    class Config:
-        populate_by_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    model_config = MONGO_VALUE_CONFIG
 
 class Medicion(BaseModel):
     id: Optional[PyObjectId] = Field(default_factory=PyObjectId, alias="_id")
@@ -138,10 +145,7 @@ class Medicion(BaseModel):
     valores: Dict[str, Any]
     fecha: datetime = Field(default_factory=datetime.utcnow)
     quien_realizo: Optional[str] = None
-    class Config:
-        populate_by_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    model_config = MONGO_MODEL_CONFIG
 
 class ExerciseInRoutine(BaseModel):
     name: str
@@ -155,6 +159,7 @@ class ExerciseInRoutine(BaseModel):
     equipamiento: Optional[str] = None
     superficie: Optional[str] = None
     tags_ia: Optional[str] = None
+    model_config = ConfigDict(frozen=True)
 
 class RoutineResponse(BaseModel):
     name: str
@@ -167,9 +172,20 @@ class RoutineRequest(BaseModel):
     goals: Optional[List[str]] = None
 
 class ECGMeasurementIn(BaseModel):
-    user_id: str
+    user_id: PyObjectId
     timestamp: datetime
     fs: float
     bpm_series: List[float]
     bpm_mean: float
     ecg_segment: List[float]
+    # Solo muestras finitas: ecg_segment se empaqueta a int16 (ver ecg._pack_signal)
+    model_config = ConfigDict(allow_inf_nan=False)
+
+    @field_validator('timestamp')
+    @classmethod
+    def timestamp_as_naive_utc(cls, v: datetime) -> datetime:
+        # Mismo formato que el resto de fechas (utcnow): un lote que mezcla "...Z" y
+        # fechas sin zona se puede comparar y ordenar
+        if v.tzinfo is not None:
+            return v.astimezone(timezone.utc).replace(tzinfo=None)
+        return v
@@ -1,17 +1,170 @@
 import os
-import json
-from typing import Dict, List, Optional
+import hashlib
+import orjson
+import jiter
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
 from datetime import datetime, timedelta
 import openai
 from openai import OpenAI
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from .db import get_database
-from .models import SensorReading, UserProfile
+from .models import UserProfile
+
+
+# Campos de las lecturas que usan los prompts (se evita traer ecg_data)
+READING_PROMPT_FIELDS = {
+    "_id": 0,
+    "timestamp": 1,
+    "spo2": 1,
+    "co2": 1,
+    "heart_rate": 1,
+    "respiratory_rate": 1,
+    "temperature": 1,
+}
+
+
+ANALYSIS_SYSTEM_PROMPT = """Eres un experto fisiólogo deportivo y entrenador personal especializado en análisis de datos de sensores biomédicos. 
+                        Tu trabajo es analizar datos fisiológicos en tiempo real y proporcionar recomendaciones precisas y seguras para atletas.
+                        
+                        IMPORTANTE: 
+                        - Si detectas valores peligrosos (SpO2 < 90%, FC > 200 bpm, CO2 > 1000 ppm), recomienda detener el ejercicio inmediatamente
+                        - Siempre prioriza la seguridad del usuario
+                        - Proporciona recomendaciones específicas y accionables
+                        - Considera el contexto del usuario (nivel de fitness, deporte, etc.)
+                        """
+
+WORKOUT_SYSTEM_PROMPT = """Eres un entrenador personal experto que crea rutinas de ejercicio personalizadas basadas en datos fisiológicos reales.
+                        Debes considerar:
+                        - El perfil del usuario (edad, peso, nivel de fitness, deporte preferido)
+                        - Los datos fisiológicos recientes (SpO2, CO2, frecuencia cardíaca)
+                        - Las tendencias y patrones en los datos
+                        - Los objetivos de fitness del usuario
+                        
+                        Proporciona rutinas específicas, seguras y progresivas.
+                        """
+
+# Por defecto un modelo con modo JSON (response_format); gpt-4 no lo admite
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+# Modelos sin soporte de response_format (modo JSON); con el resto se activa siempre
+LEGACY_MODELS = {"gpt-4", "gpt-4-0613", "gpt-4-0314"}
+
+# Estados finales de OpenAI con resultados que recoger: un batch expirado o cancelado
+# también deja en output_file_id las peticiones que llegaron a completarse (y se cobran)
+COLLECTABLE_BATCH_STATUSES = {"completed", "expired", "cancelled"}
+
+# Código de error de MongoDB para una clave _id repetida
+DUPLICATE_KEY_ERROR = 11000
+
+# Bytes nuevos del stream entre dos intentos de parsear el análisis parcial
+STREAM_PARTIAL_BYTES = int(os.getenv("OPENAI_STREAM_PARTIAL_BYTES", "128"))
+
+# Ventana de datos (horas) de cada tipo de petición; la misma que usan las llamadas directas
+BATCH_WINDOW_HOURS = {"analysis": 2, "workout": 24}
+
+# Un único cliente para todo el proceso: reutiliza el pool de conexiones HTTP (keep-alive/TLS)
+# en lugar de abrir uno por instancia. El semáforo limita las peticiones simultáneas a
+# OpenAI (límites RPM/TPM de la cuenta) cuando se llama desde varios hilos a la vez.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+_openai_slots = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+_openai_client: Optional[OpenAI] = None
+
+# Respuestas recientes por cuerpo de petición (modelo + mensajes + parámetros): un prompt
+# idéntico dentro del TTL no vuelve a llamar a OpenAI. Compartida entre instancias.
+COMPLETION_CACHE_TTL = int(os.getenv("OPENAI_CACHE_TTL", "300"))
+COMPLETION_CACHE_SIZE = 256
+_completion_cache: Dict[str, tuple] = {}
+_completion_cache_lock = threading.Lock()
+
+# Datos de usuario por (user_id, ventana) durante USER_DATA_TTL segundos: análisis y
+# recomendación seguidos para el mismo usuario comparten las consultas. Es de módulo
+# porque SmartBreathingOpenAI se crea en cada petición. POST /api/sensors/readings
+# invalida a los usuarios con lecturas nuevas (invalidate_user_data).
+USER_DATA_TTL = 10
+USER_DATA_CACHE_SIZE = 1024
+_user_data_cache: Dict[tuple, tuple] = {}
+_user_data_cache_lock = threading.Lock()
+
+
+def get_openai_client() -> OpenAI:
+    global _openai_client
+    if _openai_client is None:
+        # El pool keep-alive por defecto del SDK ya supera OPENAI_MAX_CONCURRENCY;
+        # solo se acorta el timeout de conexión para no retener slots
+        _openai_client = OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=openai.Timeout(OPENAI_TIMEOUT, connect=5.0),
+        )
+    return _openai_client
+
+
+def invalidate_user_data(user_ids) -> None:
+    """Descarta los datos en caché de estos usuarios (todas las ventanas)"""
+    user_ids = set(user_ids)
+    with _user_data_cache_lock:
+        for key in [k for k in _user_data_cache if k[0] in user_ids]:
+            del _user_data_cache[key]
 
 
 class SmartBreathingOpenAI:
     def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = get_openai_client()
         self.db = get_database()
+
+    def _chat_body(self, system_prompt: str, prompt: str, temperature: float, max_tokens: int) -> Dict:
+        """Cuerpo de la petición de chat (mismo formato en llamada directa y en batch)"""
+        body = {
+            "model": OPENAI_MODEL,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt},
+            ],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        if OPENAI_MODEL not in LEGACY_MODELS:
+            # Modo JSON: la respuesta siempre es un objeto JSON válido (los prompts lo piden)
+            body["response_format"] = {"type": "json_object"}
+        return body
+
+    def _chat(self, system_prompt: str, prompt: str, temperature: float, max_tokens: int) -> str:
+        """Llamada a ChatGPT con el límite de concurrencia compartido"""
+        body = self._chat_body(system_prompt, prompt, temperature, max_tokens)
+        key = hashlib.blake2b(orjson.dumps(body, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        with _completion_cache_lock:
+            cached = _completion_cache.get(key)
+        if cached and time.monotonic() - cached[0] < COMPLETION_CACHE_TTL:
+            return cached[1]
+
+        with _openai_slots:
+            response = self.client.chat.completions.create(**body)
+        content = response.choices[0].message.content
+
+        with _completion_cache_lock:
+            if len(_completion_cache) >= COMPLETION_CACHE_SIZE:
+                # Se descarta la entrada más antigua
+                _completion_cache.pop(min(_completion_cache, key=lambda k: _completion_cache[k][0]))
+            _completion_cache[key] = (time.monotonic(), content)
+        return content
+
+    def _chat_stream(
+        self, system_prompt: str, prompt: str, temperature: float, max_tokens: int
+    ) -> Iterator[str]:
+        """Como _chat, pero entrega el texto según lo va generando el modelo"""
+        body = self._chat_body(system_prompt, prompt, temperature, max_tokens)
+        # Si el consumidor abandona el generador (cliente desconectado), close() cierra
+        # la respuesta HTTP y libera el slot aquí, sin esperar al recolector de basura
+        _openai_slots.acquire()
+        try:
+            with self.client.chat.completions.create(**body, stream=True) as stream:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        finally:
+            _openai_slots.release()
         
     def analyze_user_physiology(self, user_id: str, time_window_hours: int = 2) -> Dict:
         """
@@ -32,35 +185,20 @@ class SmartBreathingOpenAI:
         
         try:
             # Llamar a ChatGPT
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """Eres un experto fisiólogo deportivo y entrenador personal especializado en análisis de datos de sensores biomédicos. 
-                        Tu trabajo es analizar datos fisiológicos en tiempo real y proporcionar recomendaciones precisas y seguras para atletas.
-                        
-                        IMPORTANTE: 
-                        - Si detectas valores peligrosos (SpO2 < 90%, FC > 200 bpm, CO2 > 1000 ppm), recomienda detener el ejercicio inmediatamente
-                        - Siempre prioriza la seguridad del usuario
-                        - Proporciona recomendaciones específicas y accionables
-                        - Considera el contexto del usuario (nivel de fitness, deporte, etc.)
-                        """
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
+            response_text = self._chat(
+                ANALYSIS_SYSTEM_PROMPT,
+                prompt,
                 temperature=0.3,  # Respuestas más consistentes
-                max_tokens=1000
+                max_tokens=1000,
             )
             
             # Parsear respuesta
-            analysis_result = self._parse_chatgpt_response(response.choices[0].message.content)
+            analysis_result = self._parse_chatgpt_response(response_text)
             
             # Guardar análisis en la base de datos
-            self._save_analysis(user_id, analysis_result, user_data)
+            self._save_analysis(
+                user_id, analysis_result, len(user_data["readings"]), time_window_hours
+            )
             
             return analysis_result
             
@@ -71,40 +209,77 @@ class SmartBreathingOpenAI:
                 "recommendations": []
             }
     
+    def analyze_user_physiology_stream(
+        self, user_id: str, time_window_hours: int = 2
+    ) -> Iterator[Dict]:
+        """
+        Versión en streaming de analyze_user_physiology: entrega el análisis parcial
+        (JSON incompleto, parseado con jiter) según llegan los tokens, y al final el
+        análisis completo, que se guarda igual que en la llamada directa.
+        """
+        user_data = self._get_user_data(user_id, time_window_hours)
+
+        if not user_data["readings"]:
+            yield {
+                "status": "no_data",
+                "message": "No hay datos suficientes para análisis",
+                "recommendations": []
+            }
+            return
+
+        prompt = self._create_analysis_prompt(user_data)
+        buffer = bytearray()
+        parsed_at = 0
+        last_partial = None
+        chunks = self._chat_stream(ANALYSIS_SYSTEM_PROMPT, prompt, 0.3, 1000)
+        try:
+            for delta in chunks:
+                buffer += delta.encode()
+                # Se reparsea cada STREAM_PARTIAL_BYTES bytes nuevos, no en cada token, y solo
+                # se entrega el parcial si ha cambiado: menos CPU y menos líneas NDJSON
+                if len(buffer) - parsed_at < STREAM_PARTIAL_BYTES:
+                    continue
+                if not buffer.lstrip().startswith(b"{"):
+                    continue
+                parsed_at = len(buffer)
+                try:
+                    partial = jiter.from_json(bytes(buffer), partial_mode="trailing-strings")
+                except ValueError:
+                    # Fragmento aún no parseable (p. ej. a mitad de un número o una clave)
+                    continue
+                if partial != last_partial:
+                    last_partial = partial
+                    yield partial
+
+            analysis_result = self._parse_chatgpt_response(buffer.decode())
+            self._save_analysis(
+                user_id, analysis_result, len(user_data["readings"]), time_window_hours
+            )
+            yield analysis_result
+
+        except Exception as e:
+            yield {
+                "status": "error",
+                "message": f"Error en análisis de IA: {str(e)}",
+                "recommendations": []
+            }
+        finally:
+            chunks.close()
+
     def generate_workout_recommendation(self, user_id: str, current_routine: Optional[Dict] = None) -> Dict:
         """
         Genera recomendaciones de entrenamiento personalizadas usando ChatGPT
         """
-        user_data = self._get_user_data(user_id, 24)  # Últimas 24 horas
+        user_data = self._get_workout_data(user_id, 24)  # Últimas 24 horas
         
         prompt = self._create_workout_prompt(user_data, current_routine)
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """Eres un entrenador personal experto que crea rutinas de ejercicio personalizadas basadas en datos fisiológicos reales.
-                        Debes considerar:
-                        - El perfil del usuario (edad, peso, nivel de fitness, deporte preferido)
-                        - Los datos fisiológicos recientes (SpO2, CO2, frecuencia cardíaca)
-                        - Las tendencias y patrones en los datos
-                        - Los objetivos de fitness del usuario
-                        
-                        Proporciona rutinas específicas, seguras y progresivas.
-                        """
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.4,
-                max_tokens=1200
+            response_text = self._chat(
+                WORKOUT_SYSTEM_PROMPT, prompt, temperature=0.4, max_tokens=1200
             )
             
-            recommendation = self._parse_workout_response(response.choices[0].message.content)
+            recommendation = self._parse_workout_response(response_text)
             
             # Guardar recomendación
             self._save_workout_recommendation(user_id, recommendation)
@@ -118,15 +293,200 @@ class SmartBreathingOpenAI:
                 "routine": None
             }
     
+    # -------------------------------------------------------------------------
+    # BATCH API (análisis no interactivos: nocturnos / cron)
+    # -------------------------------------------------------------------------
+    def submit_batch(self, user_ids: List[str], kind: str) -> Optional[str]:
+        """
+        Envía los análisis ("analysis") o rutinas ("workout") de varios usuarios a la
+        Batch API de OpenAI: ventana de 24 h, hasta un 50% más barata y sin consumir
+        el límite RPM de las llamadas interactivas. Devuelve el id del batch (o None si
+        no hay nada que enviar); los resultados se recogen con collect_batch().
+        """
+        if kind not in BATCH_WINDOW_HOURS:
+            raise ValueError(f"Tipo de batch desconocido: {kind}")
+
+        window = BATCH_WINDOW_HOURS[kind]
+        requests = []
+        data_points = {}
+        for user_id in user_ids:
+            if kind == "analysis":
+                user_data = self._get_user_data(user_id, window)
+                if not user_data["user_profile"] or not user_data["readings"]:
+                    continue
+                body = self._chat_body(
+                    ANALYSIS_SYSTEM_PROMPT, self._create_analysis_prompt(user_data), 0.3, 1000
+                )
+                data_points[user_id] = len(user_data["readings"])
+            else:
+                user_data = self._get_workout_data(user_id, window)
+                if not user_data["user_profile"]:
+                    continue
+                body = self._chat_body(
+                    WORKOUT_SYSTEM_PROMPT, self._create_workout_prompt(user_data, None), 0.4, 1200
+                )
+            requests.append(
+                {"custom_id": user_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+            )
+
+        if not requests:
+            return None
+
+        jsonl = b"\n".join(orjson.dumps(r, default=str) for r in requests)
+        batch_file = self.client.files.create(file=("batch.jsonl", jsonl), purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"kind": kind},
+        )
+        self.db.ai_batches.insert_one({
+            "batch_id": batch.id,
+            "kind": kind,
+            "data_points": data_points,
+            "status": batch.status,
+            "created_at": datetime.utcnow(),
+        })
+        return batch.id
+
+    def collect_batch(self, batch_id: str) -> str:
+        """
+        Consulta un batch enviado con submit_batch(). Si ha terminado (o ha expirado o se
+        ha cancelado: se guarda lo que llegó a completarse), guarda cada resultado igual
+        que la llamada directa (_save_analysis / _save_workout_recommendation).
+        Devuelve el estado del batch ("collected" cuando ya se han guardado los resultados).
+        """
+        record = self.db.ai_batches.find_one({"batch_id": batch_id})
+        if not record:
+            raise ValueError(f"Batch no encontrado: {batch_id}")
+        if record["status"] == "collected":
+            return "collected"
+
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status not in COLLECTABLE_BATCH_STATUSES:
+            self.db.ai_batches.update_one({"batch_id": batch_id}, {"$set": {"status": batch.status}})
+            return batch.status
+        if not batch.output_file_id:
+            # Terminado sin ningún resultado válido (solo error_file_id): no hay nada que
+            # guardar, pero el batch ya es final y no debe volver a consultarse
+            return self._mark_collected(batch, 0)
+
+        window = BATCH_WINDOW_HOURS[record["kind"]]
+        docs = []
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            user_id = result["custom_id"]
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            if record["kind"] == "analysis":
+                doc = self._analysis_doc(
+                    user_id,
+                    self._parse_chatgpt_response(content),
+                    record["data_points"].get(user_id, 0),
+                    window,
+                )
+            else:
+                doc = self._workout_recommendation_doc(
+                    user_id, self._parse_workout_response(content)
+                )
+            # _id determinista: si una recogida anterior se cortó a medias, reintentarla
+            # no duplica los resultados que ya se escribieron
+            doc["_id"] = f"{batch_id}:{user_id}"
+            docs.append(doc)
+
+        if docs:
+            # Todos los resultados del batch en una sola escritura, con el write concern por
+            # defecto: regenerarlos supone pagar el batch otra vez (j=False solo para telemetría)
+            name = "analyses" if record["kind"] == "analysis" else "workout_recommendations"
+            try:
+                self.db[name].insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # Solo se ignoran los duplicados de un intento anterior; otro error deja
+                # el batch pendiente para el siguiente poll
+                if any(err["code"] != DUPLICATE_KEY_ERROR for err in e.details["writeErrors"]):
+                    raise
+
+        return self._mark_collected(batch, len(docs))
+
+    def _mark_collected(self, batch, saved: int) -> str:
+        # failed: peticiones sin resultado guardado (con error o sin ejecutar si expiró o
+        # se canceló); batch_status conserva el estado final de OpenAI
+        self.db.ai_batches.update_one(
+            {"batch_id": batch.id},
+            {"$set": {
+                "status": "collected",
+                "batch_status": batch.status,
+                "failed": batch.request_counts.total - saved,
+                "collected_at": datetime.utcnow(),
+            }},
+        )
+        return "collected"
+
+    def _get_user_profile(self, user_id: str) -> Optional[Dict]:
+        # Los _id de users son ObjectId (los creados vía /api/users/ pueden ser str)
+        user_ids = [ObjectId(user_id), user_id] if ObjectId.is_valid(user_id) else [user_id]
+        return self.db.users.find_one({"_id": {"$in": user_ids}})
+
+    def _get_workout_data(self, user_id: str, time_window_hours: int) -> Dict:
+        """
+        Datos para el prompt de rutina: perfil y medias de las últimas 100 lecturas.
+        Las medias se calculan en MongoDB ($group): llegan 3 números en vez de 100 documentos.
+        """
+        since = datetime.utcnow() - timedelta(hours=time_window_hours)
+        pipeline = [
+            {"$match": {"user_id": user_id, "timestamp": {"$gte": since}}},
+            {"$sort": {"timestamp": -1}},
+            {"$limit": 100},
+            {
+                "$group": {
+                    "_id": None,
+                    "avg_spo2": {"$avg": "$spo2"},
+                    "avg_co2": {"$avg": "$co2"},
+                    "avg_hr": {"$avg": "$heart_rate"},
+                }
+            },
+        ]
+        return {
+            "user_profile": self._get_user_profile(user_id),
+            "averages": next(self.db.sensor_readings.aggregate(pipeline), None) or {},
+            "time_window_hours": time_window_hours,
+        }
+
     def _get_user_data(self, user_id: str, time_window_hours: int) -> Dict:
+        """Datos del usuario, con caché de USER_DATA_TTL segundos por (user_id, ventana)"""
+        key = (user_id, time_window_hours)
+        with _user_data_cache_lock:
+            cached = _user_data_cache.get(key)
+        if cached and time.monotonic() - cached[0] < USER_DATA_TTL:
+            return cached[1]
+
+        user_data = self._fetch_user_data(user_id, time_window_hours)
+        now = time.monotonic()
+        with _user_data_cache_lock:
+            # Se limpian las entradas caducadas para que la caché no crezca sin límite
+            for k in [k for k, (ts, _) in _user_data_cache.items() if now - ts >= USER_DATA_TTL]:
+                del _user_data_cache[k]
+            if len(_user_data_cache) >= USER_DATA_CACHE_SIZE:
+                # Se descarta la entrada más antigua (los dict mantienen el orden de inserción)
+                _user_data_cache.pop(next(iter(_user_data_cache)))
+            _user_data_cache[key] = (now, user_data)
+        return user_data
+
+    def _fetch_user_data(self, user_id: str, time_window_hours: int) -> Dict:
         """Obtiene datos del usuario desde MongoDB"""
         # Obtener perfil del usuario
-        user_profile = self.db.users.find_one({"_id": user_id})
+        user_profile = self._get_user_profile(user_id)
         
         # Obtener lecturas recientes
         since = datetime.utcnow() - timedelta(hours=time_window_hours)
+        # Documentos tal cual (solo los campos del prompt): el prompt no necesita modelos
         readings = list(self.db.sensor_readings.find(
             {"user_id": user_id, "timestamp": {"$gte": since}},
+            projection=READING_PROMPT_FIELDS,
             sort=[("timestamp", -1)],
             limit=100
         ))
@@ -141,6 +501,7 @@ class SmartBreathingOpenAI:
         # Obtener recomendaciones recientes
         recent_recommendations = list(self.db.recommendations.find(
             {"user_id": user_id},
+            projection={"_id": 0, "recommendation_type": 1, "message": 1, "created_at": 1},
             sort=[("created_at", -1)],
             limit=10
         ))
@@ -185,7 +546,7 @@ class SmartBreathingOpenAI:
         - Nivel de fitness: {user.get('fitness_level', 'N/A')}
 
         DATOS DE SENSORES (últimas {len(sensor_data)} lecturas):
-        {json.dumps(sensor_data, indent=2, default=str)}
+        {orjson.dumps(sensor_data, default=str, option=orjson.OPT_INDENT_2).decode()}
 
         Por favor proporciona:
         1. ANÁLISIS GENERAL: Resumen del estado fisiológico actual
@@ -217,15 +578,12 @@ class SmartBreathingOpenAI:
     def _create_workout_prompt(self, user_data: Dict, current_routine: Optional[Dict]) -> str:
         """Crea un prompt para recomendaciones de entrenamiento"""
         user = user_data["user_profile"]
-        readings = user_data["readings"]
+        averages = user_data["averages"]
         
-        # Calcular estadísticas básicas
-        if readings:
-            avg_spo2 = sum(r["spo2"] for r in readings) / len(readings)
-            avg_co2 = sum(r["co2"] for r in readings) / len(readings)
-            avg_hr = sum(r["heart_rate"] for r in readings) / len(readings)
-        else:
-            avg_spo2 = avg_co2 = avg_hr = 0
+        # Estadísticas básicas (calculadas en MongoDB; 0 si no hay lecturas)
+        avg_spo2 = averages.get("avg_spo2") or 0
+        avg_co2 = averages.get("avg_co2") or 0
+        avg_hr = averages.get("avg_hr") or 0
         
         prompt = f"""
         Crea una rutina de entrenamiento personalizada basada en estos datos:
@@ -242,7 +600,7 @@ class SmartBreathingOpenAI:
         - CO2: {avg_co2:.0f} ppm
         - Frecuencia cardíaca: {avg_hr:.0f} bpm
 
-        RUTINA ACTUAL: {json.dumps(current_routine, default=str) if current_routine else "Ninguna"}
+        RUTINA ACTUAL: {orjson.dumps(current_routine, default=str).decode() if current_routine else "Ninguna"}
 
         Crea una rutina que:
         1. Sea apropiada para el nivel de fitness del usuario
@@ -280,7 +638,7 @@ class SmartBreathingOpenAI:
         try:
             # Intentar parsear como JSON
             if response_text.strip().startswith('{'):
-                return json.loads(response_text)
+                return orjson.loads(response_text)
             else:
                 # Si no es JSON válido, crear estructura básica
                 return {
@@ -296,7 +654,7 @@ class SmartBreathingOpenAI:
                     "next_steps": "Continuar monitoreo",
                     "confidence_score": 0.5
                 }
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             return {
                 "analysis_summary": response_text,
                 "alerts": [],
@@ -309,36 +667,46 @@ class SmartBreathingOpenAI:
     def _parse_workout_response(self, response_text: str) -> Dict:
         """Parsea la respuesta de recomendación de entrenamiento"""
         try:
-            return json.loads(response_text)
-        except json.JSONDecodeError:
+            return orjson.loads(response_text)
+        except orjson.JSONDecodeError:
             return {
                 "status": "error",
                 "message": "Error parseando recomendación de entrenamiento",
                 "routine": None
             }
     
-    def _save_analysis(self, user_id: str, analysis: Dict, user_data: Dict):
-        """Guarda el análisis en la base de datos"""
-        analysis_doc = {
+    def _analysis_doc(
+        self, user_id: str, analysis: Dict, data_points: int, time_window_hours: int
+    ) -> Dict:
+        return {
             "user_id": user_id,
             "analysis_type": "physiological",
             "analysis_data": analysis,
-            "data_points_analyzed": len(user_data["readings"]),
-            "time_window_hours": user_data["time_window_hours"],
+            "data_points_analyzed": data_points,
+            "time_window_hours": time_window_hours,
             "created_at": datetime.utcnow(),
-            "ai_model": "gpt-4"
+            "ai_model": OPENAI_MODEL
         }
-        
-        self.db.analyses.insert_one(analysis_doc)
-    
-    def _save_workout_recommendation(self, user_id: str, recommendation: Dict):
-        """Guarda la recomendación de entrenamiento"""
-        recommendation_doc = {
+
+    def _save_analysis(
+        self, user_id: str, analysis: Dict, data_points: int, time_window_hours: int
+    ):
+        """Guarda el análisis en la base de datos"""
+        self.db.analyses.insert_one(
+            self._analysis_doc(user_id, analysis, data_points, time_window_hours)
+        )
+
+    def _workout_recommendation_doc(self, user_id: str, recommendation: Dict) -> Dict:
+        return {
             "user_id": user_id,
             "recommendation_type": "workout",
             "recommendation_data": recommendation,
             "created_at": datetime.utcnow(),
-            "ai_model": "gpt-4"
+            "ai_model": OPENAI_MODEL
         }
-        
-        self.db.workout_recommendations.insert_one(recommendation_doc)
+
+    def _save_workout_recommendation(self, user_id: str, recommendation: Dict):
+        """Guarda la recomendación de entrenamiento"""
+        self.db.workout_recommendations.insert_one(
+            self._workout_recommendation_doc(user_id, recommendation)
+        )
@@ -0,0 +1,103 @@
+import hashlib
+from typing import Any, AsyncIterator, Optional
+
+import orjson
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import Receive, Scope, Send
+
+
+def _dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
+class MongoJSONResponse(JSONResponse):
+    """Respuesta JSON serializada con orjson; los ObjectId (y otros tipos BSON) salen como str."""
+
+    def render(self, content: Any) -> bytes:
+        return _dumps(content)
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Si Accept-Encoding admite gzip, respetando los q-values ("gzip;q=0" lo rechaza)."""
+    wildcard = None
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding in ("gzip", "x-gzip"):
+            return q > 0
+        if coding == "*":
+            wildcard = q > 0
+    return bool(wildcard)
+
+
+class NegotiatedGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware que no comprime si el cliente rechaza gzip con q=0.
+
+    Starlette solo mira si "gzip" aparece en Accept-Encoding; aquí se quita la
+    cabecera cuando la negociación dice que no, y el resto lo decide Starlette.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+            if "gzip" in accept_encoding and not accepts_gzip(accept_encoding):
+                scope = {
+                    **scope,
+                    "headers": [(k, v) for k, v in scope["headers"] if k != b"accept-encoding"],
+                }
+        await super().__call__(scope, receive, send)
+
+
+async def stream_json_array(cursor) -> AsyncIterator[bytes]:
+    """Serializa un cursor de Motor como array JSON documento a documento."""
+    yield b"["
+    first = True
+    async for doc in cursor:
+        yield _dumps(doc) if first else b"," + _dumps(doc)
+        first = False
+    yield b"]"
+
+
+def cursor_response(cursor) -> StreamingResponse:
+    """Respuesta JSON que se envía según llegan los documentos del cursor."""
+    return StreamingResponse(stream_json_array(cursor), media_type="application/json")
+
+
+# El navegador guarda la respuesta pero revalida siempre: los datos se consultan a menudo
+# y pueden cambiar, así que se evita reenviar el cuerpo cuando no ha cambiado
+JSON_CACHE_CONTROL = "private, no-cache"
+
+
+def content_etag(content: Any) -> str:
+    return hashlib.md5(_dumps(content)).hexdigest()
+
+
+def etag_json_response(
+    request: Request, content: Any, etag: Optional[str] = None
+) -> Response:
+    """JSON con ETag débil; si coincide con If-None-Match se devuelve 304 sin cuerpo.
+
+    Sin ``etag`` se calcula con el md5 del JSON serializado.
+    """
+    body = None
+    if etag is None:
+        body = _dumps(content)
+        etag = hashlib.md5(body).hexdigest()
+    etag = f'W/"{etag}"'
+    headers = {"ETag": etag, "Cache-Control": JSON_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if body is None:
+        body = _dumps(content)
+    return Response(body, media_type="application/json", headers=headers)
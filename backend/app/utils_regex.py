@@ -1,3 +1,9 @@
+from functools import lru_cache
+from typing import Any, Dict, List
+
+
+# tipo_bloque sale de un catálogo con pocos valores: se memoriza el resultado por valor
+@lru_cache(maxsize=128)
 def block_regex_safe(block: str) -> str:
     """Helper for safe regex construction from block type"""
     if not block: return "Principal"
@@ -7,3 +13,17 @@ def block_regex_safe(block: str) -> str:
     if "Principal" in block or "Núcleo" in block: return "Principal|Núcleo"
     if "Vuelta" in block: return "Vuelta"
     return "Principal"
+
+
+# Campos de Ejercicios donde se buscan las keywords de deporte
+SPORT_KEYWORD_FIELDS = ("modalidad", "superficie", "tags_ia", "ejercicio")
+
+
+def sport_keyword_conditions(keywords: str) -> List[Dict[str, Any]]:
+    """
+    Condiciones de $or para las keywords de deporte ("a|b|c"): regex sin distinguir
+    mayúsculas, que casan como subcadena ("bici" dentro de "bicimontaña"). No se usa
+    $text: busca palabras enteras y parte "peso corporal" en términos sueltos, así que
+    cambiaría qué ejercicios salen.
+    """
+    return [{field: {"$regex": keywords, "$options": "i"}} for field in SPORT_KEYWORD_FIELDS]
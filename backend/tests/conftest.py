@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+from fastapi.testclient import TestClient
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+
+
+class AsyncCursor:
+    """Cursor de mongomock con la interfaz asíncrona de Motor que usa la app."""
+
+    def __init__(self, docs):
+        self._docs = iter(list(docs))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        return list(self._docs)[:length]
+
+
+class AsyncCollection:
+    def __init__(self, collection):
+        self.sync = collection
+
+    def aggregate(self, pipeline, **kwargs):
+        return AsyncCursor(self.sync.aggregate(pipeline))
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.sync.find(*args, **kwargs))
+
+    async def bulk_write(self, requests, ordered=True):
+        # bulk_write de mongomock no acepta las operaciones de PyMongo >= 4.11: se aplican
+        # una a una. Sin semántica de errores de lote: la primera excepción se propaga
+        counts = dict(inserted=0, matched=0, modified=0, deleted=0, upserted=0)
+        for op in requests:
+            if isinstance(op, InsertOne):
+                self.sync.insert_one(op._doc)
+                counts["inserted"] += 1
+            elif isinstance(op, (DeleteOne, DeleteMany)):
+                delete = self.sync.delete_one if isinstance(op, DeleteOne) else self.sync.delete_many
+                counts["deleted"] += delete(op._filter).deleted_count
+            else:
+                if isinstance(op, ReplaceOne):
+                    res = self.sync.replace_one(op._filter, op._doc, upsert=op._upsert)
+                elif isinstance(op, UpdateOne):
+                    res = self.sync.update_one(op._filter, op._doc, upsert=op._upsert)
+                elif isinstance(op, UpdateMany):
+                    res = self.sync.update_many(op._filter, op._doc, upsert=op._upsert)
+                else:
+                    raise TypeError(f"Operación de bulk_write no soportada: {op!r}")
+                counts["matched"] += res.matched_count
+                counts["modified"] += res.modified_count
+                counts["upserted"] += res.upserted_id is not None
+        return SimpleNamespace(**{f"{k}_count": v for k, v in counts.items()})
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+class AsyncDatabase:
+    """Base de datos mongomock envuelta para llamar a los endpoints de Motor sin servidor."""
+
+    def __init__(self, db):
+        self.sync = db
+
+    def get_collection(self, name, **kwargs):
+        return AsyncCollection(self.sync[name])
+
+    def __getattr__(self, name):
+        return AsyncCollection(self.sync[name])
+
+
+@pytest.fixture
+def mongo_db():
+    return AsyncDatabase(mongomock.MongoClient()["SmartBreathing"])
+
+
+@pytest.fixture
+def api_client(mongo_db):
+    """Cliente HTTP sobre la app con get_db apuntando a mongo_db (sin eventos de arranque)."""
+    from app.db import get_db
+    from app.main import app
+
+    app.dependency_overrides[get_db] = lambda: mongo_db
+    yield TestClient(app)
+    app.dependency_overrides.pop(get_db, None)
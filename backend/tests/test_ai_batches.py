@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+import mongomock
+import orjson
+import pytest
+
+from app.ai_batches import FINAL_BATCH_STATUSES
+from app.openai_client import SmartBreathingOpenAI
+
+
+class FakeOpenAI:
+    """Solo lo que usa collect_batch: batches.retrieve y files.content."""
+
+    def __init__(self, batch, output=b""):
+        self.batches = SimpleNamespace(retrieve=lambda batch_id: batch)
+        self.files = SimpleNamespace(content=lambda file_id: SimpleNamespace(text=output.decode()))
+
+
+def analyzer(batch, output=b""):
+    ai = SmartBreathingOpenAI.__new__(SmartBreathingOpenAI)
+    ai.client = FakeOpenAI(batch, output)
+    ai.db = mongomock.MongoClient()["SmartBreathing"]
+    ai.db.ai_batches.insert_one(
+        {"batch_id": "batch_1", "kind": "analysis", "data_points": {"u1": 3}, "status": "in_progress"}
+    )
+    return ai
+
+
+def finished_batch(status, output_file_id, total, completed):
+    return SimpleNamespace(
+        id="batch_1",
+        status=status,
+        output_file_id=output_file_id,
+        request_counts=SimpleNamespace(total=total, completed=completed, failed=total - completed),
+    )
+
+
+def result_line(user_id, content):
+    return orjson.dumps({
+        "custom_id": user_id,
+        "response": {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}},
+    })
+
+
+def test_completed_batch_without_output_is_final():
+    batch = finished_batch("completed", None, total=2, completed=0)
+    ai = analyzer(batch)
+
+    assert ai.collect_batch("batch_1") == "collected"
+    record = ai.db.ai_batches.find_one({"batch_id": "batch_1"})
+    assert record["status"] == "collected"
+    assert record["failed"] == 2
+
+
+def test_retried_collection_does_not_duplicate_results():
+    batch = finished_batch("completed", "file_1", total=2, completed=2)
+    output = b"\n".join([result_line("u1", '{"analysis_summary": "ok"}'), result_line("u2", "{}")])
+    ai = analyzer(batch, output)
+    # Un intento anterior llegó a escribir el resultado de u1 antes de cortarse
+    ai.db.analyses.insert_one({"_id": "batch_1:u1", "user_id": "u1"})
+
+    assert ai.collect_batch("batch_1") == "collected"
+    assert sorted(d["_id"] for d in ai.db.analyses.find()) == ["batch_1:u1", "batch_1:u2"]
+
+
+@pytest.mark.parametrize("status", ["expired", "cancelled"])
+def test_expired_and_cancelled_batches_keep_their_partial_results(status):
+    # 3 peticiones: una completada, una con error, una sin ejecutar al expirar/cancelar
+    error = orjson.dumps({"custom_id": "u2", "response": {"status_code": 500, "body": {}}})
+    batch = finished_batch(status, "file_1", total=3, completed=1)
+    ai = analyzer(batch, b"\n".join([result_line("u1", '{"analysis_summary": "ok"}'), error]))
+
+    assert ai.collect_batch("batch_1") == "collected"
+    assert [d["_id"] for d in ai.db.analyses.find()] == ["batch_1:u1"]
+    record = ai.db.ai_batches.find_one({"batch_id": "batch_1"})
+    assert (record["status"], record["batch_status"], record["failed"]) == ("collected", status, 2)
+
+
+def test_running_batch_stays_pending():
+    ai = analyzer(SimpleNamespace(id="batch_1", status="finalizing"))
+
+    assert ai.collect_batch("batch_1") == "finalizing"
+    assert ai.db.ai_batches.find_one({"batch_id": "batch_1"})["status"] not in FINAL_BATCH_STATUSES
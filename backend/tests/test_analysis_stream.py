@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import orjson
+
+from app import openai_client
+from app.openai_client import SmartBreathingOpenAI
+
+
+class FakeStream:
+    def __init__(self, text):
+        self.chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + 4]))])
+            for i in range(0, len(text), 4)
+        ]
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+
+def streaming_analyzer(monkeypatch, text):
+    stream = FakeStream(text)
+    ai = SmartBreathingOpenAI.__new__(SmartBreathingOpenAI)
+    ai.client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **body: stream))
+    )
+    monkeypatch.setattr(
+        ai, "_get_user_data", lambda user_id, hours: {"user_profile": {}, "readings": [object()]}
+    )
+    monkeypatch.setattr(ai, "_create_analysis_prompt", lambda user_data: "prompt")
+    monkeypatch.setattr(ai, "_save_analysis", lambda *args: None)
+    return ai, stream
+
+
+ANALYSIS = orjson.dumps({
+    "analysis_summary": "Estado estable " * 20,
+    "alerts": [],
+    "recommendations": [{"type": "rest", "message": "Descansa " * 20}],
+}).decode()
+
+
+def test_stream_sends_few_changed_partials_and_then_the_full_analysis(monkeypatch):
+    ai, stream = streaming_analyzer(monkeypatch, ANALYSIS)
+
+    parts = list(ai.analyze_user_physiology_stream("u1"))
+
+    partials = parts[:-1]
+    assert len(partials) <= len(ANALYSIS) // openai_client.STREAM_PARTIAL_BYTES
+    assert all(a != b for a, b in zip(partials, partials[1:]))
+    assert parts[-1] == orjson.loads(ANALYSIS)
+    assert stream.closed
+
+
+def test_abandoned_stream_releases_its_openai_slot(monkeypatch):
+    ai, stream = streaming_analyzer(monkeypatch, ANALYSIS)
+    free_slots = openai_client._openai_slots._value
+
+    parts = ai.analyze_user_physiology_stream("u1")
+    next(parts)
+    assert openai_client._openai_slots._value == free_slots - 1
+    parts.close()
+
+    assert stream.closed
+    assert openai_client._openai_slots._value == free_slots
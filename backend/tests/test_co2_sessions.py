@@ -0,0 +1,16 @@
+import asyncio
+
+from app.main import app, enqueue_co2_session
+
+
+def test_repeated_login_queues_a_single_co2_session(monkeypatch):
+    queue = asyncio.Queue()
+    monkeypatch.setattr(app.state, "co2_sessions", queue, raising=False)
+    monkeypatch.setattr(app.state, "co2_pending", set(), raising=False)
+
+    for _ in range(3):
+        enqueue_co2_session("user-a")
+    enqueue_co2_session("user-b")
+
+    assert queue.qsize() == 2
+    assert [queue.get_nowait(), queue.get_nowait()] == ["user-a", "user-b"]
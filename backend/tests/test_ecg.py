@@ -0,0 +1,188 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+from app import ecg
+from app.ecg import (
+    _pack_signal,
+    _unpack_signal,
+    create_ecg_measurement,
+    create_ecg_measurements_batch,
+)
+from app.models import ECGMeasurementIn
+
+
+def measurement(user_id, bpm, ts=None):
+    return ECGMeasurementIn(
+        user_id=user_id,
+        timestamp=ts or datetime(2024, 1, 2, 10, 0),
+        fs=250.0,
+        bpm_series=[bpm],
+        bpm_mean=bpm,
+        ecg_segment=[0.1, -0.2, 0.3],
+    )
+
+
+def seed_mediciones(mongo_db, user_id):
+    older = {"_id": ObjectId(), "idUsuario": user_id, "fecha": datetime(2024, 1, 1), "valores": {}}
+    newer = {"_id": ObjectId(), "idUsuario": user_id, "fecha": datetime(2024, 1, 2), "valores": {}}
+    # La antigua se inserta primero: un update sin orden por fecha acabaría en ella
+    mongo_db.sync.Mediciones.insert_many([older, newer])
+    return older["_id"], newer["_id"]
+
+
+def test_single_and_batch_update_the_latest_medicion(mongo_db):
+    user_id = ObjectId()
+    older_id, newer_id = seed_mediciones(mongo_db, user_id)
+
+    single = asyncio.run(create_ecg_measurement(measurement(user_id, 70.0), db=mongo_db))
+    assert single["medicion_id"] == str(newer_id)
+
+    asyncio.run(create_ecg_measurements_batch([measurement(user_id, 80.0)], db=mongo_db))
+
+    mediciones = mongo_db.sync.Mediciones
+    assert mediciones.find_one({"_id": newer_id})["valores"] == {"bpm": 80.0}
+    assert mediciones.find_one({"_id": older_id})["valores"] == {}
+    assert mediciones.count_documents({"idUsuario": user_id}) == 2
+
+
+def test_batch_uses_latest_measurement_per_user_and_creates_missing(mongo_db):
+    known, new = ObjectId(), ObjectId()
+    _, newer_id = seed_mediciones(mongo_db, known)
+    t0 = datetime(2024, 1, 3, 9, 0)
+
+    result = asyncio.run(
+        create_ecg_measurements_batch(
+            [
+                measurement(known, 90.0, t0 + timedelta(seconds=5)),
+                measurement(known, 60.0, t0),
+                measurement(new, 75.0, t0),
+            ],
+            db=mongo_db,
+        )
+    )
+
+    assert result["ecg_inserted"] == 3
+    assert result["mediciones_created"] == 1
+    mediciones = mongo_db.sync.Mediciones
+    assert mediciones.find_one({"_id": newer_id})["valores"] == {"bpm": 90.0}
+    created = mediciones.find_one({"idUsuario": new})
+    assert created["valores"] == {"bpm": 75.0}
+    assert created["fecha"] == t0
+
+
+def test_pack_signal_round_trip():
+    signal = [0.0, 1.25, -0.5, 0.001, -1.25]
+    packed, scale = _pack_signal(signal)
+
+    assert len(packed) == 2 * len(signal)  # int16
+    restored = _unpack_signal({"senal": packed, "senal_dtype": "int16", "senal_scale": scale})
+    assert len(restored) == len(signal)
+    for original, value in zip(signal, restored):
+        assert abs(original - value) <= scale / 2
+    # El pico se conserva exacto: define la escala
+    assert restored[1] == 1.25
+
+
+def test_pack_signal_all_zeros():
+    packed, scale = _pack_signal([0.0, 0.0])
+    assert scale == 1.0
+    assert _unpack_signal({"senal": packed, "senal_dtype": "int16", "senal_scale": scale}) == [0.0, 0.0]
+
+
+def test_unpack_signal_legacy_array():
+    assert _unpack_signal({"senal": [0.1, 0.2]}) == [0.1, 0.2]
+
+
+@pytest.mark.parametrize("bad", [float("nan"), float("inf"), float("-inf")])
+def test_ecg_measurement_rejects_non_finite_samples(bad):
+    with pytest.raises(ValidationError):
+        ECGMeasurementIn(
+            user_id=ObjectId(),
+            timestamp=datetime(2024, 1, 2, 10, 0),
+            fs=250.0,
+            bpm_series=[70.0],
+            bpm_mean=70.0,
+            ecg_segment=[0.1, bad],
+        )
+
+
+def test_pack_signal_subnormal_peak():
+    packed, scale = _pack_signal([5e-324, 0.0])
+    assert scale == 1.0
+    assert _unpack_signal({"senal": packed, "senal_dtype": "int16", "senal_scale": scale}) == [0.0, 0.0]
+
+
+def test_batch_accepts_mixed_utc_and_naive_timestamps(mongo_db):
+    user_id = ObjectId()
+    data = {"user_id": str(user_id), "fs": 250.0, "bpm_series": [70.0], "ecg_segment": [0.1]}
+    batch = [
+        ECGMeasurementIn(**data, timestamp="2024-01-03T09:00:05Z", bpm_mean=90.0),
+        ECGMeasurementIn(**data, timestamp="2024-01-03T09:00:00", bpm_mean=60.0),
+        ECGMeasurementIn(**data, timestamp="2024-01-03T10:00:01+02:00", bpm_mean=50.0),
+    ]
+    # +02:00 se normaliza a 08:00:01 UTC: la más reciente es la de las 09:00:05Z
+    assert batch[2].timestamp == datetime(2024, 1, 3, 8, 0, 1)
+
+    asyncio.run(create_ecg_measurements_batch(batch, db=mongo_db))
+
+    created = mongo_db.sync.Mediciones.find_one({"idUsuario": user_id})
+    assert created["valores"] == {"bpm": 90.0}
+    assert created["fecha"] == datetime(2024, 1, 3, 9, 0, 5)
+
+
+def test_batch_skips_mediciones_for_ecg_docs_that_failed(mongo_db, monkeypatch):
+    ok_user, failed_user = ObjectId(), ObjectId()
+
+    class FailingEcg:
+        async def insert_many(self, docs, ordered=True):
+            raise BulkWriteError({"nInserted": 1, "writeErrors": [{"index": 1, "code": 1, "errmsg": "boom"}]})
+
+    monkeypatch.setattr(ecg, "telemetry_collection", lambda db, name: FailingEcg())
+
+    response = asyncio.run(
+        create_ecg_measurements_batch(
+            [measurement(ok_user, 70.0), measurement(failed_user, 80.0)], db=mongo_db
+        )
+    )
+
+    assert response.status_code == 207
+    assert json.loads(response.body) == {
+        "ecg_inserted": 1,
+        "ecg_failed": [1],
+        "mediciones_updated": 0,
+        "mediciones_created": 1,
+    }
+    assert mongo_db.sync.Mediciones.find_one({"idUsuario": failed_user}) is None
+
+
+def test_batch_endpoint_over_http(api_client, mongo_db):
+    known, new = ObjectId(), ObjectId()
+    _, newer_id = seed_mediciones(mongo_db, known)
+    body = [
+        {"user_id": str(known), "timestamp": "2024-01-03T09:00:05Z", "fs": 250.0,
+         "bpm_series": [90.0], "bpm_mean": 90.0, "ecg_segment": [0.1, -0.2]},
+        {"user_id": str(known), "timestamp": "2024-01-03T09:00:00", "fs": 250.0,
+         "bpm_series": [60.0], "bpm_mean": 60.0, "ecg_segment": [0.3]},
+        {"user_id": str(new), "timestamp": "2024-01-03T09:00:00", "fs": 250.0,
+         "bpm_series": [75.0], "bpm_mean": 75.0, "ecg_segment": [0.0]},
+    ]
+
+    response = api_client.post("/api/ecg-measurements/batch", json=body)
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "ecg_inserted": 3, "ecg_failed": [], "mediciones_updated": 1, "mediciones_created": 1,
+    }
+    assert mongo_db.sync.ecg.count_documents({"senal_dtype": "int16"}) == 3
+    assert mongo_db.sync.Mediciones.find_one({"_id": newer_id})["valores"] == {"bpm": 90.0}
+    assert mongo_db.sync.Mediciones.find_one({"idUsuario": new})["valores"] == {"bpm": 75.0}
+
+
+def test_batch_endpoint_rejects_an_empty_batch(api_client):
+    assert api_client.post("/api/ecg-measurements/batch", json=[]).status_code == 400
@@ -0,0 +1,9 @@
+import pytest
+from bson import ObjectId
+
+
+@pytest.mark.parametrize("limit", [0, -1, 100000])
+def test_mediciones_reject_out_of_range_limit(api_client, limit):
+    # Se rechaza antes de abrir el stream: 422 en vez de un 200 con el JSON cortado
+    response = api_client.get("/api/mediciones", params={"user_id": str(ObjectId()), "limit": limit})
+    assert response.status_code == 422
@@ -0,0 +1,64 @@
+from typing import Annotated
+
+import pytest
+from bson import ObjectId
+from pydantic import BaseModel, ValidationError, WithJsonSchema
+
+from app.models import PyObjectId, SensorReading, UserCreate
+
+
+def reading(user_id):
+    return SensorReading(user_id=user_id, spo2=97.0, co2=450.0, heart_rate=70)
+
+
+def test_pyobjectid_accepts_objectid_hex_and_bytes():
+    oid = ObjectId()
+    assert reading(oid).user_id == oid
+    assert reading(str(oid)).user_id == oid
+    assert reading(oid.binary).user_id == oid
+
+
+@pytest.mark.parametrize("value", ["not-an-id", "z" * 24, "0" * 23, b"short", 123, None])
+def test_pyobjectid_rejects_invalid_values(value):
+    with pytest.raises(ValidationError):
+        reading(value)
+
+
+def test_pyobjectid_serializes_as_string():
+    oid = ObjectId()
+    assert reading(oid).model_dump(mode="json")["user_id"] == str(oid)
+
+
+def test_pyobjectid_field_annotations_do_not_leak_between_models():
+    class Tagged(BaseModel):
+        ref: Annotated[PyObjectId, WithJsonSchema({"type": "string", "format": "objectid"})]
+
+    class Plain(BaseModel):
+        ref: PyObjectId
+
+    assert Tagged.model_json_schema()["properties"]["ref"]["format"] == "objectid"
+    assert "format" not in Plain.model_json_schema()["properties"]["ref"]
+
+
+@pytest.mark.parametrize("codigo,ok", [("1234", True), ("0000", True), ("123", False), ("12345", False), ("12a4", False), ("١٢٣٤", False)])
+def test_user_create_codigo(codigo, ok):
+    data = {
+        "nombre": "Ana", "apellido": "Pérez", "codigo": codigo,
+        "condiciones_limitantes": "no", "genero": "F", "edad": 30, "peso": 60.0,
+        "sport_preference": "running", "fitness_level": "medio", "objetivo_deportivo": "resistencia",
+        "grado_exigencia": "medio", "frecuencia_entrenamiento": 3, "tiempo_dedicable_diario": 30,
+        "equipamiento": "ninguno", "sistema_recompensas": "puntos",
+    }
+    if ok:
+        assert UserCreate(**data).codigo == codigo
+    else:
+        with pytest.raises(ValidationError):
+            UserCreate(**data)
+
+
+@pytest.mark.parametrize("bad", [float("nan"), float("inf")])
+def test_sensor_reading_rejects_non_finite_values(bad):
+    with pytest.raises(ValidationError):
+        SensorReading(user_id=ObjectId(), spo2=97.0, co2=450.0, heart_rate=70, ecg_data=[0.1, bad])
+    with pytest.raises(ValidationError):
+        SensorReading(user_id=ObjectId(), spo2=bad, co2=450.0, heart_rate=70)
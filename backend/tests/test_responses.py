@@ -0,0 +1,80 @@
+import pytest
+from bson import ObjectId
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app.responses import NegotiatedGZipMiddleware, accepts_gzip, content_etag, etag_json_response
+
+
+def request_with(headers=None):
+    raw = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw})
+
+
+def test_content_etag_is_stable_and_content_sensitive():
+    oid = ObjectId()
+    assert content_etag({"_id": oid, "a": 1}) == content_etag({"_id": oid, "a": 1})
+    assert content_etag({"_id": oid, "a": 1}) != content_etag({"_id": oid, "a": 2})
+
+
+def test_etag_response_returns_body_and_weak_etag():
+    response = etag_json_response(request_with(), {"_id": ObjectId("0" * 24), "n": 1})
+
+    assert response.status_code == 200
+    assert response.body == b'{"_id":"000000000000000000000000","n":1}'
+    assert response.headers["etag"].startswith('W/"')
+    assert response.headers["cache-control"] == "private, no-cache"
+
+
+def test_etag_response_304_when_if_none_match_matches():
+    content = {"n": 1}
+    etag = etag_json_response(request_with(), content).headers["etag"]
+
+    response = etag_json_response(request_with({"If-None-Match": etag}), content)
+
+    assert response.status_code == 304
+    assert response.body == b""
+    assert response.headers["etag"] == etag
+
+
+def test_etag_response_explicit_etag():
+    response = etag_json_response(request_with({"If-None-Match": 'W/"abc"'}), {"n": 1}, etag="abc")
+    assert response.status_code == 304
+
+    response = etag_json_response(request_with({"If-None-Match": 'W/"old"'}), {"n": 1}, etag="abc")
+    assert response.status_code == 200
+    assert response.headers["etag"] == 'W/"abc"'
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ("gzip, deflate, br", True),
+        ("br;q=1.0, gzip;q=0.8", True),
+        ("GZIP", True),
+        ("x-gzip", True),
+        ("gzip;q=0", False),
+        ("gzip; q=0.0, identity", False),
+        ("*", True),
+        ("*;q=0", False),
+        ("gzip;q=0, *", False),
+        ("deflate, br", False),
+        ("", False),
+    ],
+)
+def test_accepts_gzip_honours_q_values(header, expected):
+    assert accepts_gzip(header) is expected
+
+
+def test_gzip_middleware_skips_clients_that_refuse_gzip():
+    app = Starlette(routes=[Route("/", lambda request: PlainTextResponse("x" * 1000))])
+    app.add_middleware(NegotiatedGZipMiddleware, minimum_size=500)
+    client = TestClient(app)
+
+    assert client.get("/", headers={"Accept-Encoding": "gzip"}).headers["content-encoding"] == "gzip"
+    refused = client.get("/", headers={"Accept-Encoding": "gzip;q=0, identity"})
+    assert "content-encoding" not in refused.headers
+    assert refused.text == "x" * 1000
@@ -0,0 +1,62 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from fastapi import BackgroundTasks, HTTPException
+
+from app.main import create_sensor_readings, get_sensor_readings
+from app.models import SensorReading
+
+
+async def body_of(response):
+    chunks = [chunk async for chunk in response.body_iterator]
+    return json.loads(b"".join(c if isinstance(c, bytes) else c.encode() for c in chunks))
+
+
+def reading(user_id, hour, **extra):
+    return SensorReading(
+        user_id=user_id, timestamp=datetime(2024, 1, 1, hour), spo2=97.0, co2=450.0, heart_rate=70, **extra
+    )
+
+
+def test_posted_readings_are_listed_for_their_user(mongo_db):
+    user_id, other = ObjectId(), ObjectId()
+    readings = [
+        reading(user_id, 9),
+        reading(user_id, 10, ecg_data=[0.1, -0.2]),
+        reading(other, 11),
+    ]
+    result = asyncio.run(create_sensor_readings(readings, BackgroundTasks(), db=mongo_db))
+    assert result == {"inserted": 3, "users": 2}
+
+    response = asyncio.run(get_sensor_readings(str(user_id), db=mongo_db))
+    docs = asyncio.run(body_of(response))
+
+    assert [d["timestamp"] for d in docs] == ["2024-01-01T10:00:00", "2024-01-01T09:00:00"]
+    assert {d["user_id"] for d in docs} == {str(user_id)}
+    assert docs[0]["_id"] == str(readings[1].id)
+    # La señal empaquetada no sale en el listado
+    assert "ecg_data" not in docs[0]
+
+
+def test_sensor_readings_accept_uppercase_id(mongo_db):
+    user_id = ObjectId()
+    asyncio.run(create_sensor_readings([reading(user_id, 9)], BackgroundTasks(), db=mongo_db))
+
+    response = asyncio.run(get_sensor_readings(str(user_id).upper(), db=mongo_db))
+    assert len(asyncio.run(body_of(response))) == 1
+
+
+def test_sensor_readings_invalid_id(mongo_db):
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(get_sensor_readings("not-an-id", db=mongo_db))
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.parametrize("limit", [0, -5])
+def test_sensor_readings_reject_non_positive_limit(api_client, limit):
+    # 422 antes de abrir el stream, no un $limit inválido con el 200 ya enviado
+    response = api_client.get(f"/api/sensors/readings/{ObjectId()}", params={"limit": limit})
+    assert response.status_code == 422
@@ -0,0 +1,44 @@
+from datetime import datetime
+
+import mongomock
+from bson import ObjectId
+
+from app import openai_client
+from app.openai_client import SmartBreathingOpenAI, invalidate_user_data
+
+
+def test_user_data_is_reused_until_the_user_gets_new_readings(monkeypatch):
+    monkeypatch.setattr(openai_client, "_user_data_cache", {})
+    fetches = []
+    ai = SmartBreathingOpenAI.__new__(SmartBreathingOpenAI)
+    monkeypatch.setattr(
+        ai, "_fetch_user_data", lambda user_id, hours: fetches.append((user_id, hours)) or {}
+    )
+
+    ai._get_user_data("u1", 2)
+    ai._get_user_data("u1", 2)
+    ai._get_user_data("u2", 2)
+    assert fetches == [("u1", 2), ("u2", 2)]
+
+    invalidate_user_data(["u1"])
+    ai._get_user_data("u1", 2)
+    ai._get_user_data("u2", 2)
+    assert fetches == [("u1", 2), ("u2", 2), ("u1", 2)]
+
+
+def test_analysis_prompt_is_built_from_the_stored_reading_dicts():
+    ai = SmartBreathingOpenAI.__new__(SmartBreathingOpenAI)
+    ai.db = mongomock.MongoClient()["SmartBreathing"]
+    user_id = ObjectId()
+    ai.db.users.insert_one({"_id": user_id, "name": "Ana"})
+    ai.db.sensor_readings.insert_one({
+        "_id": str(ObjectId()), "user_id": str(user_id), "timestamp": datetime.utcnow(),
+        "spo2": 96.5, "co2": 455.0, "heart_rate": 71, "ecg_data": b"\x00\x01",
+    })
+
+    user_data = ai._fetch_user_data(str(user_id), 2)
+
+    # Solo los campos del prompt, sin construir modelos
+    assert list(user_data["readings"][0]) == ["timestamp", "spo2", "co2", "heart_rate"]
+    prompt = ai._create_analysis_prompt(user_data)
+    assert '"spo2": 96.5' in prompt and '"temperature": null' in prompt
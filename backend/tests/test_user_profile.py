@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+from app import main
+from app.main import load_user_profile
+
+
+@pytest.fixture(autouse=True)
+def clear_profile_cache():
+    main._user_profile_cache.clear()
+    yield
+    main._user_profile_cache.clear()
+
+
+def test_load_user_profile_finds_objectid_user_by_string_id(mongo_db):
+    oid = ObjectId()
+    mongo_db.sync.users.insert_one({"_id": oid, "name": "Ana", "edad": 30, "weight": 60.0})
+
+    profile = asyncio.run(load_user_profile(mongo_db, str(oid)))
+
+    assert profile.id == oid
+    assert profile.name == "Ana"
+    assert profile.weight == 60.0
+
+
+def test_load_user_profile_invalid_id(mongo_db):
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(load_user_profile(mongo_db, "not-an-id"))
+    assert exc.value.status_code == 400
+
+
+def test_load_user_profile_missing_user(mongo_db):
+    # Un _id guardado como string no debe encontrarse con la búsqueda por ObjectId
+    oid = ObjectId()
+    mongo_db.sync.users.insert_one({"_id": str(oid), "name": "Ana"})
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(load_user_profile(mongo_db, str(oid)))
+    assert exc.value.status_code == 404
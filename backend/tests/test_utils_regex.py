@@ -0,0 +1,56 @@
+import re
+
+import mongomock
+import pytest
+
+from app.utils_regex import block_regex_safe, sport_keyword_conditions
+
+
+@pytest.mark.parametrize(
+    "block,expected",
+    [
+        ("", "Principal"),
+        (None, "Principal"),
+        ("Calentamiento", "Calentamiento"),
+        ("Calentamiento articular", "Calentamiento"),
+        ("Principal", "Principal|Núcleo"),
+        ("Bloque Núcleo", "Principal|Núcleo"),
+        ("Vuelta a la calma", "Vuelta"),
+        ("Otro", "Principal"),
+        # Prioridad: Calentamiento gana a Principal
+        ("Calentamiento + Principal", "Calentamiento"),
+    ],
+)
+def test_block_regex_safe(block, expected):
+    assert block_regex_safe(block) == expected
+
+
+def test_block_regex_safe_is_a_valid_pattern():
+    assert re.search(block_regex_safe("Núcleo"), "Bloque Núcleo")
+
+
+def test_sport_keywords_match_as_substrings_in_any_field():
+    conditions = sport_keyword_conditions("ciclismo|bicicleta|rodillo|bici")
+    assert [next(iter(c)) for c in conditions] == ["modalidad", "superficie", "tags_ia", "ejercicio"]
+
+    catalog = mongomock.MongoClient().db.Ejercicios
+    catalog.insert_many([
+        {"ejercicio": "Rodaje en BICIMONTAÑA"},
+        {"tags_ia": "rodillos, cadencia"},
+        {"ejercicio": "Press con peso libre"},
+    ])
+    found = {d.get("ejercicio") or d.get("tags_ia") for d in catalog.find({"$or": conditions})}
+    assert found == {"Rodaje en BICIMONTAÑA", "rodillos, cadencia"}
+
+
+def test_multi_word_sport_keywords_match_as_phrases():
+    conditions = sport_keyword_conditions("calistenia|peso corporal|barras|street workout")
+
+    catalog = mongomock.MongoClient().db.Ejercicios
+    catalog.insert_many([
+        {"ejercicio": "Sentadilla con peso corporal"},
+        {"ejercicio": "Press con peso libre"},
+        {"tags_ia": "barrasparalelas"},
+    ])
+    found = {d.get("ejercicio") or d.get("tags_ia") for d in catalog.find({"$or": conditions})}
+    assert found == {"Sentadilla con peso corporal", "barrasparalelas"}
@@ -1,11 +1,13 @@
 import os
 import json
 import asyncio
+import time
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Awaitable, Callable, Tuple
 
 from dotenv import load_dotenv
 from bson import ObjectId
+from pymongo import DeleteMany, InsertOne
 
 from telegram import (
     Update,
@@ -50,6 +52,13 @@ AUTH_ASK_NAME, AUTH_ASK_LAST_NAME, AUTH_ASK_PASSWORD = range(3)
 # Other states
 MAIN_MENU, VIEWING_DATA, CREATING_ROUTINE, CHAT_MODE = range(3, 7)
 
+# Conexiones simultáneas hacia el backend y hacia la API de Telegram
+HTTP_POOL_SIZE = int(os.getenv("BOT_HTTP_POOL", "32"))
+HTTP_TIMEOUT = float(os.getenv("BOT_HTTP_TIMEOUT", "90"))
+
+# Segundos que se reutilizan análisis, lecturas y contexto de un usuario entre comandos
+USER_CACHE_TTL = int(os.getenv("BOT_USER_CACHE_TTL", "60"))
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -61,8 +70,73 @@ class SmartBreathingBot:
         self.api_base_url = os.getenv("API_BASE_URL", "http://localhost:8000")
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         self.user_sessions: Dict[int, Dict] = {}
+        # Sesión HTTP compartida con el backend (keep-alive), se crea en el primer uso
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._openai = None
+        # (tipo, user_id) -> (instante, valor); un lock por clave para no repetir consultas simultáneas
+        self._user_cache: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self._user_cache_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
         logger.info(f"Initialized SmartBreathingBot with API_BASE_URL: {self.api_base_url}")
 
+    def _http_session(self) -> aiohttp.ClientSession:
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=HTTP_POOL_SIZE, ttl_dns_cache=300, keepalive_timeout=75
+                ),
+                # La generación de rutinas espera a OpenAI en el backend (timeout 60 s)
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=5),
+            )
+        return self._http
+
+    def _openai_client(self):
+        # Cliente asíncrono único: no bloquea el bucle y reutiliza las conexiones TLS
+        if self._openai is None:
+            import openai
+            self._openai = openai.AsyncOpenAI(api_key=self.openai_api_key, timeout=30.0)
+        return self._openai
+
+    async def close_http_session(self) -> None:
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        if self._openai is not None:
+            await self._openai.close()
+
+    async def _cached(
+        self, key: Tuple[str, str], factory: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """Devuelve el valor de la caché o lo obtiene con factory (None no se guarda)."""
+        cached = self._user_cache.get(key)
+        if cached and time.monotonic() - cached[0] < USER_CACHE_TTL:
+            return cached[1]
+
+        lock = self._user_cache_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Otro comando pudo rellenarla mientras se esperaba el lock
+            cached = self._user_cache.get(key)
+            if cached and time.monotonic() - cached[0] < USER_CACHE_TTL:
+                return cached[1]
+
+            value = await factory()
+            now = time.monotonic()
+            # Se limpian las entradas caducadas para que la caché no crezca sin límite
+            for k, (ts, _) in list(self._user_cache.items()):
+                if now - ts >= USER_CACHE_TTL:
+                    self._user_cache.pop(k, None)
+            if value is not None:
+                self._user_cache[key] = (now, value)
+            # Y los locks sin entrada que nadie tiene tomado (el de esta clave sí lo está);
+            # como mucho, una consulta en curso repetiría la petición con un lock nuevo
+            for k, other in list(self._user_cache_locks.items()):
+                if k not in self._user_cache and not other.locked():
+                    self._user_cache_locks.pop(k, None)
+            return value
+
+    def _invalidate_user_cache(self, user_id: Any) -> None:
+        user_id = str(user_id)
+        for key in [k for k in self._user_cache if k[1] == user_id]:
+            self._user_cache.pop(key, None)
+
     def _get_message_by_tone(self, key: str, user_data: Dict) -> str:
         """Returns a localized message based on the user's 'grado_exigencia'."""
         grado = (user_data.get("grado_exigencia") or "").lower()
@@ -265,39 +339,52 @@ class SmartBreathingBot:
             return result
 
         try:
+            # El usuario llega siempre de la sesión; solo se cachean las consultas
             user_oid = user["_id"]
-
-            # Último registro de ejercicio
-            reg_col = db.db.RegistroUsuarioEjercicio
-            last_ex_cursor = (
-                reg_col.find({"idUsuario": user_oid})
-                .sort("fecha_interaccion", -1)
-                .limit(1)
+            result.update(
+                await self._cached(
+                    ("context", str(user_oid)),
+                    lambda: self._fetch_user_db_context(user_oid),
+                )
             )
-            last_ex_docs = await last_ex_cursor.to_list(length=1)
-            if last_ex_docs:
-                result["latest_exercise_record"] = last_ex_docs[0]
-
-            # Mediciones: solo 2 fechas más recientes, ordenadas por fecha
-            med_col = db.db.Mediciones
-            try:
-                # Intento 1: ObjectId
-                med_cursor = med_col.find({"idUsuario": user_oid}).sort("fecha", -1).limit(2)
-                readings = await med_cursor.to_list(length=2)
-                if not readings:
-                    # Intento 2: String
-                    med_cursor = med_col.find({"idUsuario": str(user_oid)}).sort("fecha", -1).limit(2)
-                    readings = await med_cursor.to_list(length=2)
-            except:
-                 readings = []
-
-            result["latest_measurements"] = readings
-
         except Exception as e:
             logger.error(f"Error loading full user context: {e}")
 
         return result
 
+    async def _fetch_user_db_context(self, user_oid: ObjectId) -> Dict:
+        """Último registro de ejercicio y últimas mediciones del usuario."""
+        # Último registro de ejercicio
+        last_ex_query = (
+            db.db.RegistroUsuarioEjercicio.find({"idUsuario": user_oid})
+            .sort("fecha_interaccion", -1)
+            .limit(1)
+            .to_list(length=1)
+        )
+        # Mediciones: solo 2 fechas más recientes, ordenadas por fecha.
+        # idUsuario puede estar como ObjectId o como string: una sola consulta con $in
+        med_query = (
+            db.db.Mediciones.find({"idUsuario": {"$in": [user_oid, str(user_oid)]}})
+            .sort("fecha", -1)
+            .limit(2)
+            .to_list(length=2)
+        )
+        # Consultas independientes: se lanzan a la vez y el fallo de una no anula la otra
+        last_ex_docs, readings = await asyncio.gather(
+            last_ex_query, med_query, return_exceptions=True
+        )
+        if isinstance(last_ex_docs, Exception):
+            logger.error(f"Error loading latest exercise record: {last_ex_docs}")
+            last_ex_docs = []
+        if isinstance(readings, Exception):
+            logger.error(f"Error loading latest measurements: {readings}")
+            readings = []
+
+        return {
+            "latest_exercise_record": last_ex_docs[0] if last_ex_docs else None,
+            "latest_measurements": readings,
+        }
+
     def _build_user_summary(self, full_context: Dict) -> str:
         user = full_context.get("user") or {}
         latest_ex = full_context.get("latest_exercise_record")
@@ -680,6 +767,7 @@ Confianza del Análisis: {analysis.get('confidence_score', 0) * 100:.0f}%
                         "fuente": "telegram_bot"
                     }
                     await col.insert_one(doc)
+                    self._invalidate_user_cache(user_data["_id"])
                     logger.info(f"Saved extra exercise for user {user_data['_id']}")
 
                 context.user_data["awaiting_extra_exercise_detail"] = False
@@ -993,20 +1081,20 @@ Confianza del Análisis: {analysis.get('confidence_score', 0) * 100:.0f}%
                     
                     # Call backend for alternative
                     user_oid = str(user_data["_id"])
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(
-                            f"{self.api_base_url}/api/ai/alternative-exercise/{user_oid}",
-                            json={"exercise_id": ex_id}
-                        ) as resp:
-                            if resp.status == 200:
-                                new_ex = await resp.json()
-                                # Update routine in memory
-                                routine["exercises"][idx] = new_ex
-                                context.user_data["proposed_routine"] = routine
-                                await query.answer("✅ Ejercicio cambiado")
-                                await self._show_proposed_routine(update, context)
-                            else:
-                                await query.answer("❌ No se encontró alternativa", show_alert=True)
+                    session = self._http_session()
+                    async with session.post(
+                        f"{self.api_base_url}/api/ai/alternative-exercise/{user_oid}",
+                        json={"exercise_id": ex_id}
+                    ) as resp:
+                        if resp.status == 200:
+                            new_ex = await resp.json()
+                            # Update routine in memory
+                            routine["exercises"][idx] = new_ex
+                            context.user_data["proposed_routine"] = routine
+                            await query.answer("✅ Ejercicio cambiado")
+                            await self._show_proposed_routine(update, context)
+                        else:
+                            await query.answer("❌ No se encontró alternativa", show_alert=True)
             except Exception as e:
                 logger.error(f"Error swapping: {e}")
                 await query.answer("Error al cambiar ejercicio")
@@ -1166,16 +1254,24 @@ Confianza del Análisis: {analysis.get('confidence_score', 0) * 100:.0f}%
     # -------------------------------------------------------------------------
     # API BACKEND METHODS
     # -------------------------------------------------------------------------
+    async def _get_backend_json(self, path: str) -> Optional[Any]:
+        """GET al backend; None si la respuesta no es 200."""
+        session = self._http_session()
+        async with session.get(f"{self.api_base_url}{path}") as response:
+            if response.status == 200:
+                return await response.json()
+            return None
+
     async def _get_user_analysis(self, user_id: str) -> Dict:
         """Gets user analysis from backend"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"{self.api_base_url}/api/analysis/{user_id}"
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    return {"analysis_summary": "No data available"}
+            analysis = await self._cached(
+                ("analysis", user_id),
+                lambda: self._get_backend_json(f"/api/analysis/{user_id}"),
+            )
+            if analysis is None:
+                return {"analysis_summary": "No data available"}
+            return analysis
         except Exception as e:
             logger.error(f"Error getting analysis: {e}")
             return {"analysis_summary": "Error getting analysis"}
@@ -1183,13 +1279,11 @@ Confianza del Análisis: {analysis.get('confidence_score', 0) * 100:.0f}%
     async def _get_user_readings(self, user_id: str) -> List[Dict]:
         """Gets user readings from backend"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"{self.api_base_url}/api/sensors/readings/{user_id}"
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    return []
+            readings = await self._cached(
+                ("readings", user_id),
+                lambda: self._get_backend_json(f"/api/sensors/readings/{user_id}"),
+            )
+            return readings if readings is not None else []
         except Exception as e:
             logger.error(f"Error getting readings: {e}")
             return []
@@ -1199,14 +1293,14 @@ Confianza del Análisis: {analysis.get('confidence_score', 0) * 100:.0f}%
     ) -> Optional[Dict]:
         """Generates routine with AI via backend"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_base_url}/api/ai/generate-routine/{user_id}",
-                    json={"goals": goals},
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    return None
+            session = self._http_session()
+            async with session.post(
+                f"{self.api_base_url}/api/ai/generate-routine/{user_id}",
+                json={"goals": goals},
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+                return None
         except aiohttp.ClientConnectorError as e:
             raise e
         except Exception as e:
@@ -1278,9 +1372,12 @@ Confianza del Análisis: {analysis.get('confidence_score', 0) * 100:.0f}%
                     ecg_doc = await ecg_col.find_one({"idUsuario": user_oid}, sort=[("fecha", -1)])
                     if ecg_doc:
                          fs = ecg_doc.get("fs", 200)
-                         signal = ecg_doc.get("senal", [])
+                         # La señal nueva va empaquetada en binario; n_muestras guarda su longitud
+                         n_muestras = ecg_doc.get("n_muestras")
+                         if n_muestras is None:
+                             n_muestras = len(ecg_doc.get("senal", []))
                          # Simple metric: heart rate variability or just presence
-                         measurements_note += f"\n- ULTIMO ECG DISPONIBLE: {len(signal)} muestras a {fs}Hz. (Usar para contexto de salud cardiaca)."
+                         measurements_note += f"\n- ULTIMO ECG DISPONIBLE: {n_muestras} muestras a {fs}Hz. (Usar para contexto de salud cardiaca)."
                 except Exception:
                     pass
 
@@ -1327,9 +1424,7 @@ REGLAS ADICIONALES:
 """
 
             if self.openai_api_key:
-                import openai
-                client = openai.OpenAI(api_key=self.openai_api_key)
-                response = client.chat.completions.create(
+                response = await self._openai_client().chat.completions.create(
                     model="gpt-4o-mini",
                     messages=[
                         {
@@ -1468,6 +1563,7 @@ REGLAS ADICIONALES:
             
             if exercise_docs:
                 await reg_col.insert_many(exercise_docs)
+            self._invalidate_user_cache(user_data["_id"])
                 
             logger.info(f"Logged session {status} for user {user_data['_id']}")
             
@@ -1691,8 +1787,13 @@ REGLAS ADICIONALES:
                 )
 
             if docs:
-                await col.delete_many({"idUsuario": user_oid})
-                await col.insert_many(docs)
+                # Sustituye la rutina anterior en un único viaje: ordered=True garantiza
+                # que el borrado se aplica antes de las inserciones
+                await col.bulk_write(
+                    [DeleteMany({"idUsuario": user_oid})] + [InsertOne(d) for d in docs],
+                    ordered=True,
+                )
+                self._invalidate_user_cache(user_oid)
                 logger.info(
                     f"Saved {len(docs)} assigned exercises for user {user_oid}"
                 )
@@ -1723,8 +1824,9 @@ REGLAS ADICIONALES:
         col = db.db.ejercicios_asignados
         user_oid = user_data["_id"]
 
+        # Ambas consultas usan el índice (idUsuario, fecha_creacion_rutina) si existe
         latest_doc_cursor = (
-            col.find({"idUsuario": user_oid})
+            col.find({"idUsuario": user_oid}, {"fecha_creacion_rutina": 1})
             .sort("fecha_creacion_rutina", -1)
             .limit(1)
         )
@@ -1742,7 +1844,14 @@ REGLAS ADICIONALES:
         routine = await routine_cursor.to_list(length=100)
 
         context.user_data["current_routine_date"] = latest_date
-        
+        # Los toggles repintan desde aquí sin volver a consultar la rutina
+        context.user_data["current_routine"] = routine
+
+        await self._show_exercise_checklist(update, context, routine)
+
+    async def _show_exercise_checklist(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE, routine: List[Dict]
+    ) -> None:
         if "session_completed_exercises" not in context.user_data:
             context.user_data["session_completed_exercises"] = []
 
@@ -1812,7 +1921,14 @@ REGLAS ADICIONALES:
             
         context.user_data["session_completed_exercises"] = completed_ids
 
-        await self._register_exercises(update, context)
+        # Marcar es solo estado de sesión: se repinta con la rutina ya cargada.
+        # Si no está (reinicio del bot) o el ejercicio no es suyo (la rutina se
+        # sustituyó después de cargarla), se vuelve a leer de MongoDB.
+        routine = context.user_data.get("current_routine")
+        if routine is None or exercise_id not in {str(ex["_id"]) for ex in routine}:
+            await self._register_exercises(update, context)
+        else:
+            await self._show_exercise_checklist(update, context, routine)
 
     def _check_health_risks(self, measurements: List[Dict]) -> List[str]:
         """Checks for health risks in the latest measurement."""
@@ -1967,13 +2083,31 @@ def main() -> None:
     if not token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN not configured in .env")
 
+    # Bucle de eventos en C si uvloop está instalado (opcional). run_polling usa el
+    # bucle actual del hilo, así que basta con fijarlo antes (uvloop.install() y las
+    # políticas de bucle están obsoletas desde Python 3.12)
+    try:
+        import uvloop
+        asyncio.set_event_loop(uvloop.new_event_loop())
+    except ImportError:
+        pass
+
     bot = SmartBreathingBot()
 
-    app = Application.builder().token(token).build()
+    app = (
+        Application.builder()
+        .token(token)
+        .connection_pool_size(HTTP_POOL_SIZE)
+        .build()
+    )
+
+    async def post_shutdown(application: Application) -> None:
+        await bot.close_http_session()
+        await close_mongo_connection(application)
 
     # Conexión a MongoDB gestionada por Application
     app.post_init = connect_to_mongo
-    app.post_shutdown = close_mongo_connection
+    app.post_shutdown = post_shutdown
     
     # Add Error Handler
     app.add_error_handler(error_handler)
@@ -23,6 +23,9 @@ class DBContext:
 
 db = DBContext()
 
+# Rutina más reciente de un usuario (filtro por idUsuario + orden por fecha de creación)
+ASSIGNED_BY_USER_INDEX = [("idUsuario", 1), ("fecha_creacion_rutina", -1)]
+
 
 async def connect_to_mongo(application: Application):
     """Conecta a MongoDB y actualiza el estado de la conexión."""
@@ -36,7 +39,16 @@ async def connect_to_mongo(application: Application):
         return
 
     try:
-        db.client = motor.motor_asyncio.AsyncIOMotorClient(mongodb_uri)
+        # Un único cliente para todo el bot, con pool caliente y timeouts cortos
+        # (mismos valores que el backend: backend/app/db.py)
+        db.client = motor.motor_asyncio.AsyncIOMotorClient(
+            mongodb_uri,
+            maxPoolSize=int(os.getenv("MONGO_POOL", "50")),
+            minPoolSize=5,
+            serverSelectionTimeoutMS=2000,
+            connectTimeoutMS=2000,
+            retryWrites=True,
+        )
         # Comprobar conexión
         await db.client.admin.command("ismaster")
         db.db = db.client[db_name]
@@ -47,6 +59,20 @@ async def connect_to_mongo(application: Application):
         db.client = None
         db.db = None
         db.is_connected = False
+        return
+
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.error(f"Error creating MongoDB indexes: {e}")
+
+
+async def ensure_indexes() -> None:
+    """Índices de las consultas del bot (create_index no hace nada si ya existen)."""
+    await db.db.ejercicios_asignados.create_index(ASSIGNED_BY_USER_INDEX)
+    await db.db.RegistroUsuarioEjercicio.create_index(
+        [("idUsuario", 1), ("fecha_interaccion", -1)]
+    )
 
 
 async def close_mongo_connection(application: Application):
@@ -93,6 +119,9 @@ def is_database_connected() -> bool:
 # -------------------------------------------------------------------
 #  AUTENTICACIÓN
 # -------------------------------------------------------------------
+LOGIN_COLLATION = {"locale": "es", "strength": 2}
+
+
 async def find_user_by_credentials(name: str, last_name: str, password: str) -> Optional[Dict[str, Any]]:
     """
     Busca un usuario en SmartBreathing.users usando:
@@ -114,7 +143,9 @@ async def find_user_by_credentials(name: str, last_name: str, password: str) ->
         }
         logger.info(f"Buscando usuario con query: {query}")
 
-        user = await users_collection.find_one(query)
+        # Misma collation que el índice users_login del backend: la búsqueda
+        # es un acceso por índice y, como en el login web, ignora mayúsculas
+        user = await users_collection.find_one(query, collation=LOGIN_COLLATION)
         logger.info(f"Resultado búsqueda usuario: {user}")
         return user
 